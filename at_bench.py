@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import asyncio
+import subprocess
+import click
+import click_log
+import logging
+from at_serial import ATSerial, AsyncATSerial
+
+logging.basicConfig(format='%(asctime)s %(message)s')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def report(name, count, elapsed, cpu, errors, latencies=None):
+    click.echo('%-12s %6d cmd %9.1f cmd/s %8.1f us cpu/cmd %6d errors' % (name, count, count / elapsed, cpu / count * 1e6, errors))
+    if latencies:
+        click.echo('%-12s p50 %8.3f ms  p99 %8.3f ms' % ('', percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3))
+
+
+def bench_sequential(at, commands):
+    latencies = []
+    errors = 0
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for command in commands:
+        t = time.perf_counter()
+        if at.command(command) is None:
+            errors += 1
+        latencies.append(time.perf_counter() - t)
+    report('sequential', len(commands), time.perf_counter() - start, time.process_time() - cpu, errors, latencies)
+
+
+def bench_pipelined(at, commands):
+    cpu = time.process_time()
+    start = time.perf_counter()
+    futures = [at.command_async(command) for command in commands]
+    errors = sum(1 for future in futures if future.result() is None)
+    report('pipelined', len(commands), time.perf_counter() - start, time.process_time() - cpu, errors)
+
+
+async def bench_async(device, pipeline, binary, commands):
+    at = AsyncATSerial(device, pipeline=pipeline)
+    try:
+        if binary:
+            await at.enable_binary()
+
+        latencies = []
+        errors = 0
+        cpu = time.process_time()
+        start = time.perf_counter()
+        for command in commands:
+            t = time.perf_counter()
+            if await at.command(command) is None:
+                errors += 1
+            latencies.append(time.perf_counter() - t)
+        report('async seq', len(commands), time.perf_counter() - start, time.process_time() - cpu, errors, latencies)
+
+        cpu = time.process_time()
+        start = time.perf_counter()
+        results = await asyncio.gather(*[at.command_async(command) for command in commands])
+        errors = sum(1 for result in results if result is None)
+        report('async pipe', len(commands), time.perf_counter() - start, time.process_time() - cpu, errors)
+
+        await at.command('$STOP')
+    finally:
+        at.close()
+
+
+@click.command()
+@click.option('--count', type=int, default=1000, help="Commands per run [default: 1000].")
+@click.option('--delay', type=float, default=0.0, help="Simulated firmware delay in seconds [default: 0].")
+@click.option('--telemetry', type=float, default=None, help="Simulated telemetry interval in seconds.")
+@click.option('--pipeline', type=int, default=4, help="ATSerial pipeline depth [default: 4].")
+@click.option('--binary', is_flag=True, help="Use binary framing when the device supports it.")
+@click.option('--device', type=click.STRING, help="Benchmark a real device instead of the simulator.")
+@click.option('--async', 'use_async', is_flag=True, help="Benchmark AsyncATSerial on an asyncio loop instead of the reader thread.")
+@click_log.simple_verbosity_option(default='WARNING')
+def run(count, delay, telemetry, pipeline, binary, device, use_async):
+    sim = None
+    if not device:
+        args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'at_device_sim.py'), '--delay', str(delay), '-v', 'WARNING']
+        if telemetry:
+            args += ['--telemetry', str(telemetry)]
+        sim = subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True)
+        device = sim.stdout.readline().strip()
+
+    commands = []
+    for i in range(count):
+        if i % 2:
+            commands.append('$S%d=%d' % (i % 4 + 1, i % 180))
+        else:
+            commands.append('$FORWARD=%d,%d' % (i % 1000, i % 100))
+
+    try:
+        if use_async:
+            asyncio.run(bench_async(device, pipeline, binary, commands))
+            return
+
+        at = ATSerial(device, pipeline=pipeline)
+        reader = at.start()
+
+        if binary:
+            at.enable_binary().result()
+
+        bench_sequential(at, commands)
+        bench_pipelined(at, commands)
+
+        at.command('$STOP')
+        at.is_run = False
+        reader.join()
+    finally:
+        if sim:
+            sim.terminate()
+            sim.wait()
+
+
+if __name__ == "__main__":
+    run()
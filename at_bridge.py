@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import paho.mqtt.client
+import click
+import click_log
+import logging
+from at_serial import ATSerial
+from at_dispatch import ATDispatcher, OVERFLOW_POLICIES
+from at_router import Router, TelemetryPublisher, ack_callback, WHEELS_ROUTES, BODY_ROUTES
+from schema import SchemaError
+
+logging.basicConfig(format='%(asctime)s %(message)s')
+
+DEVICE_ROUTES = {
+    'wheels': WHEELS_ROUTES,
+    'body': BODY_ROUTES,
+}
+
+DEFAULT_RESYNC = ('wheels=$STOP', )
+
+
+def parse_devices(ctx, param, value):
+    devices = {}
+    for item in value:
+        name, sep, path = item.partition('=')
+        if not sep or not path:
+            raise click.BadParameter('expected NAME=PATH, got %s' % item)
+        if name not in DEVICE_ROUTES:
+            raise click.BadParameter('unknown device %s, use one of %s' % (name, ', '.join(DEVICE_ROUTES)))
+        if name in devices:
+            raise click.BadParameter('device %s given twice' % name)
+        devices[name] = path
+    return devices
+
+
+def parse_resync(ctx, param, value):
+    # --device is eager, so the configured devices are known here
+    devices = ctx.params.get('devices', {})
+    default = not value
+    if default:
+        value = DEFAULT_RESYNC
+    commands = {}
+    for item in value:
+        name, sep, command = item.partition('=')
+        if not sep or not command:
+            raise click.BadParameter('expected NAME=COMMAND, got %s' % item)
+        if name not in devices:
+            if default:
+                continue
+            raise click.BadParameter('no --device %s, use one of %s' % (name, ', '.join(devices)))
+        commands.setdefault(name, []).append(command)
+    return commands
+
+
+def mqtt_on_connect(mqttc, userdata, flags, rc):
+    logging.info('Connected to MQTT broker with code %s', rc)
+
+    for topic in userdata['router'].topics():
+        logging.debug('Subscribe: %s', topic)
+        mqttc.subscribe(topic)
+
+
+def mqtt_on_disconnect(mqttc, userdata, rc):
+    logging.info('Disconnect from MQTT broker with code %s', rc)
+
+
+def mqtt_on_message(mqttc, userdata, message):
+    logging.debug('Message %s %s', message.topic, message.payload)
+
+    try:
+        hit = userdata['router'].resolve(message.topic, message.payload)
+    except (ValueError, SchemaError) as e:
+        logging.warning('Invalid payload on %s: %s', message.topic, e)
+        return
+
+    if not hit:
+        return
+
+    route, cmd, reply = hit
+
+    logging.debug("at cmd %s", cmd)
+
+    callback = ack_callback(mqttc, reply, cmd) if reply else None
+
+    userdata['dispatchers'][route].submit(cmd, key=route.dispatch_key(message.topic), preempt=route.preempt, callback=callback)
+
+
+@click.command()
+@click.option('--device', 'devices', multiple=True, required=True, is_eager=True, callback=parse_devices,
+              help="Device mapping NAME=PATH, NAME is one of %s, can be repeated." % ', '.join(DEVICE_ROUTES))
+@click.option('--host', type=click.STRING, default="127.0.0.1", help="MQTT host to connect to [default: 127.0.0.1].")
+@click.option('--port', type=click.IntRange(0, 65535), default=1883, help="MQTT port to connect to [default: 1883].")
+@click.option('--username', type=click.STRING, help="MQTT username.")
+@click.option('--password', type=click.STRING, help="MQTT password.")
+@click.option('--cafile', type=click.Path(exists=True), help="MQTT cafile.")
+@click.option('--certfile', type=click.Path(exists=True), help="MQTT certfile.")
+@click.option('--keyfile', type=click.Path(exists=True), help="MQTT keyfile.")
+@click.option('--baudrate', type=int, default=115200, help="Serial baudrate the device is opened at [default: 115200].")
+@click.option('--link-baudrate', type=int, help="Negotiate this baudrate with the device after connecting.")
+@click.option('--binary', is_flag=True, help="Use binary framing for servo and wheel commands if the device supports it.")
+@click.option('--resync', multiple=True, callback=parse_resync, help="Command NAME=COMMAND sent to a device after it reconnects, can be repeated [default: %s]." % ', '.join(DEFAULT_RESYNC))
+@click.option('--query-ttl', type=float, default=0, help="Serve repeated ? queries from cache for this many seconds, 0 disables [default: 0].")
+@click.option('--queue-size', type=click.IntRange(1), default=16, help="Pending command queue size per device [default: 16].")
+@click.option('--overflow', type=click.Choice(OVERFLOW_POLICIES), default='drop-oldest', help="Full queue policy [default: drop-oldest].")
+@click.option('--telemetry-topic', type=click.STRING, default="telemetry", help="Telemetry topic prefix, device name is appended, empty to disable [default: telemetry].")
+@click.option('--telemetry-interval', type=float, default=0.2, help="Minimal interval between telemetry publishes per topic [default: 0.2].")
+@click_log.simple_verbosity_option(default='INFO')
+def run(devices, host, port, username, password, cafile, certfile, keyfile, baudrate, link_baudrate, binary, resync, query_ttl, queue_size, overflow, telemetry_topic, telemetry_interval):
+    logging.info("Process started")
+
+    routes = []
+    dispatchers = {}
+
+    mqttc = paho.mqtt.client.Client()
+
+    for name, device in devices.items():
+        at = ATSerial(device, resync=resync.get(name, ()), baudrate=baudrate)
+        at.start()
+
+        if link_baudrate:
+            at.set_baudrate(link_baudrate).result()
+
+        if binary:
+            at.enable_binary().result()
+
+        if query_ttl:
+            at.cache.declare('$', query_ttl)
+
+        dispatcher = ATDispatcher(at, size=queue_size, overflow=overflow)
+        dispatcher.start()
+
+        if telemetry_topic:
+            TelemetryPublisher(mqttc, telemetry_topic + '/' + name, telemetry_interval).subscribe(at)
+
+        for route in DEVICE_ROUTES[name]:
+            routes.append(route)
+            dispatchers[route] = dispatcher
+
+        logging.info("Device %s on %s", name, device)
+
+    mqttc.user_data_set({"router": Router(routes), "dispatchers": dispatchers})
+    mqttc.on_connect = mqtt_on_connect
+    mqttc.on_message = mqtt_on_message
+    mqttc.on_disconnect = mqtt_on_disconnect
+
+    if username:
+        mqttc.username_pw_set(username, password)
+
+    if cafile:
+        mqttc.tls_set(cafile, certfile, keyfile)
+
+    mqttc.connect(host, port, keepalive=10)
+    mqttc.loop_forever()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+import json
+import select
+import tty
+import click
+from at_serial import BinaryCodec
+import click_log
+import logging
+
+logging.basicConfig(format='%(asctime)s %(message)s')
+
+
+class DeviceSimulator:
+    """Wheel and body firmware stand-in on a pseudo-terminal"""
+
+    COMMANDS = (
+        re.compile(rb'^$'),
+        re.compile(rb'^\$STOP$'),
+        re.compile(rb'^\$(FORWARD|BACKWARD|LEFT|RIGHT)=\d+,\d+$'),
+        re.compile(rb'^\$S\d+=\d+$'),
+        re.compile(rb'^\$BAUD=\d+$'),
+    )
+
+    QUERY = re.compile(rb'^\$(S\d+)\?$')
+
+    def __init__(self, delay=0.0, telemetry=None, binary=True):
+        self._delay = delay
+        self._telemetry = telemetry
+        self._codec = BinaryCodec() if binary else None
+        self._binary = False
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.device = os.ttyname(self._slave)
+        self.is_run = False
+        self.commands = 0
+        self.state = {}
+
+    def close(self):
+        os.close(self._master)
+        os.close(self._slave)
+
+    def run(self):
+        self.is_run = True
+        buf = bytearray()
+        next_telemetry = time.monotonic() + self._telemetry if self._telemetry else None
+
+        while self.is_run:
+            timeout = None
+            if next_telemetry:
+                timeout = max(0, next_telemetry - time.monotonic())
+
+            readable, _, _ = select.select([self._master], [], [], timeout)
+
+            if readable:
+                buf += os.read(self._master, 4096)
+                while True:
+                    while buf and buf[0] in b' \t\r\n\x1b':
+                        del buf[0]
+                    if self._binary and buf and buf[0] == BinaryCodec.START:
+                        try:
+                            command, consumed = self._codec.decode(buf)
+                        except ValueError as e:
+                            logging.warning("Sim %s", e)
+                            # decode() only fails on a complete frame, skip all of it
+                            del buf[:buf[1] + 3]
+                            self._write('ERROR')
+                            continue
+                        if not consumed:
+                            break
+                        del buf[:consumed]
+                        self._handle(b'AT' + command.encode())
+                        continue
+                    end = buf.find(b'\n')
+                    if end < 0:
+                        break
+                    line = bytes(buf[:end]).strip(b' \t\r\x1b')
+                    del buf[:end + 1]
+                    if line:
+                        self._handle(line)
+
+            if next_telemetry and time.monotonic() >= next_telemetry:
+                next_telemetry += self._telemetry
+                self._write('# tick %d' % self.commands)
+                self._write(json.dumps({"uptime": round(time.monotonic(), 3), "commands": self.commands}))
+
+    def _handle(self, line):
+        logging.debug("Sim command %s", line)
+        if self._delay:
+            time.sleep(self._delay)
+        self.commands += 1
+
+        if line == b'AT$BIN=1':
+            self._binary = self._codec is not None
+            self._write('OK' if self._binary else 'ERROR')
+            return
+
+        query = self.QUERY.match(line[2:]) if line[:2] == b'AT' else None
+        if query:
+            name = query.group(1).decode()
+            self._write('+%s: %s' % (name, self.state.get(name, 0)))
+            self._write('OK')
+        elif line[:2] == b'AT' and any(c.match(line[2:]) for c in self.COMMANDS):
+            if line[2:4] == b'$S' and b'=' in line:
+                name, value = line[3:].decode().split('=')
+                self.state[name] = int(value)
+            self._write('OK')
+        else:
+            self._write('ERROR')
+
+    def _write(self, line):
+        os.write(self._master, line.encode() + b'\r\n')
+
+
+@click.command()
+@click.option('--delay', type=float, default=0.0, help="Response delay in seconds [default: 0].")
+@click.option('--telemetry', type=float, default=None, help="Unsolicited telemetry interval in seconds.")
+@click.option('--binary/--no-binary', default=True, help="Support binary framing [default: yes].")
+@click_log.simple_verbosity_option(default='INFO')
+def run(delay, telemetry, binary):
+    sim = DeviceSimulator(delay, telemetry, binary)
+    click.echo(sim.device)
+    logging.info("Simulator on %s", sim.device)
+    try:
+        sim.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.close()
+
+
+if __name__ == "__main__":
+    run()
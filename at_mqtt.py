@@ -6,6 +6,9 @@ import click
 import click_log
 import logging
 from at_serial import ATSerial
+from at_dispatch import ATDispatcher, OVERFLOW_POLICIES
+from at_router import Router, TelemetryPublisher, ack_callback, BODY_ROUTES
+from schema import SchemaError
 
 logging.basicConfig(format='%(asctime)s %(message)s')
 
@@ -13,7 +16,7 @@ logging.basicConfig(format='%(asctime)s %(message)s')
 def mqtt_on_connect(mqttc, userdata, flags, rc):
     logging.info('Connected to MQTT broker with code %s', rc)
 
-    for topic in ('at/+', ):
+    for topic in userdata['router'].topics():
         logging.debug('Subscribe: %s', topic)
         mqttc.subscribe(topic)
 
@@ -25,14 +28,22 @@ def mqtt_on_disconnect(mqttc, userdata, rc):
 def mqtt_on_message(mqttc, userdata, message):
     logging.debug('Message %s %s', message.topic, message.payload)
 
-    cmd = message.topic.split('/')[1]
+    try:
+        hit = userdata['router'].resolve(message.topic, message.payload)
+    except (ValueError, SchemaError) as e:
+        logging.warning('Invalid payload on %s: %s', message.topic, e)
+        return
 
-    cmd = '$' + cmd.upper() + '=' + message.payload.decode()
+    if not hit:
+        return
+
+    route, cmd, reply = hit
 
     logging.debug("at cmd %s", cmd)
 
-    userdata['at'].command(cmd)
+    callback = ack_callback(mqttc, reply, cmd) if reply else None
 
+    userdata['dispatcher'].submit(cmd, key=route.dispatch_key(message.topic), preempt=route.preempt, callback=callback)
 
 
 @click.command()
@@ -44,17 +55,42 @@ def mqtt_on_message(mqttc, userdata, message):
 @click.option('--cafile', type=click.Path(exists=True), help="MQTT cafile.")
 @click.option('--certfile', type=click.Path(exists=True), help="MQTT certfile.")
 @click.option('--keyfile', type=click.Path(exists=True), help="MQTT keyfile.")
+@click.option('--baudrate', type=int, default=115200, help="Serial baudrate the device is opened at [default: 115200].")
+@click.option('--link-baudrate', type=int, help="Negotiate this baudrate with the device after connecting.")
+@click.option('--binary', is_flag=True, help="Use binary framing for servo and wheel commands if the device supports it.")
+@click.option('--resync', multiple=True, help="Command sent after the device reconnects, can be repeated.")
+@click.option('--query-ttl', type=float, default=0, help="Serve repeated ? queries from cache for this many seconds, 0 disables [default: 0].")
+@click.option('--queue-size', type=click.IntRange(1), default=16, help="Pending command queue size [default: 16].")
+@click.option('--overflow', type=click.Choice(OVERFLOW_POLICIES), default='drop-oldest', help="Full queue policy [default: drop-oldest].")
+@click.option('--telemetry-topic', type=click.STRING, default="telemetry/body", help="Telemetry topic prefix, empty to disable [default: telemetry/body].")
+@click.option('--telemetry-interval', type=float, default=0.2, help="Minimal interval between telemetry publishes per topic [default: 0.2].")
 @click_log.simple_verbosity_option(default='INFO')
-def run(device, host, port, username, password, cafile, certfile, keyfile):
+def run(device, host, port, username, password, cafile, certfile, keyfile, baudrate, link_baudrate, binary, resync, query_ttl, queue_size, overflow, telemetry_topic, telemetry_interval):
     logging.info("Process started")
 
-    at = ATSerial(device)
+    at = ATSerial(device, resync=resync, baudrate=baudrate)
+    at.start()
+
+    if link_baudrate:
+        at.set_baudrate(link_baudrate).result()
+
+    if binary:
+        at.enable_binary().result()
 
-    mqttc = paho.mqtt.client.Client(userdata={"at": at})
+    if query_ttl:
+        at.cache.declare('$', query_ttl)
+
+    dispatcher = ATDispatcher(at, size=queue_size, overflow=overflow)
+    dispatcher.start()
+
+    mqttc = paho.mqtt.client.Client(userdata={"at": at, "dispatcher": dispatcher, "router": Router(BODY_ROUTES)})
     mqttc.on_connect = mqtt_on_connect
     mqttc.on_message = mqtt_on_message
     mqttc.on_disconnect = mqtt_on_disconnect
 
+    if telemetry_topic:
+        TelemetryPublisher(mqttc, telemetry_topic, telemetry_interval).subscribe(at)
+
     if username:
         mqttc.username_pw_set(username, password)
 
@@ -15,29 +15,11 @@ class CamHandler(BaseHTTPRequestHandler):
             self.send_response(200)
             self.send_header('Content-type','multipart/x-mixed-replace; boundary=--jpgboundary')
             self.end_headers()
-            while True:
-                try:
-                    frame = self.server.main.get_frame()
-                    if frame is not None:
-                        # img = cv2.circle(img, (100,100), 20, (0, 255, 255), 2)
-                        imgRGB=cv2.cvtColor(frame,cv2.COLOR_BGR2RGB)
-                        jpg = Image.fromarray(imgRGB)
-                        tmpFile = BytesIO()
-                        jpg.save(tmpFile,'JPEG')
-
-                        self.wfile.write("--jpgboundary".encode())
-                        self.send_header('Content-type','image/jpeg')
-                        self.send_header('Content-length',str(tmpFile.getbuffer().nbytes))
-                        self.end_headers()
-                        self.wfile.write(tmpFile.getbuffer())
-
-                    time.sleep(0.1)
-
-                except KeyboardInterrupt:
-                    break
-                except Exception as e:
-                    print(e)
-                    raise e
+            self.server.main.client_connected()
+            try:
+                self._stream()
+            finally:
+                self.server.main.client_disconnected()
             return
         elif self.path == '' or self.path == '/' or self.path.endswith('.html'):
             self.send_response(200)
@@ -48,6 +30,31 @@ class CamHandler(BaseHTTPRequestHandler):
             self.wfile.write('</body></html>'.encode())
             return
 
+    def _stream(self):
+        while True:
+            try:
+                frame = self.server.main.get_frame()
+                if frame is not None:
+                    # img = cv2.circle(img, (100,100), 20, (0, 255, 255), 2)
+                    imgRGB=cv2.cvtColor(frame,cv2.COLOR_BGR2RGB)
+                    jpg = Image.fromarray(imgRGB)
+                    tmpFile = BytesIO()
+                    jpg.save(tmpFile,'JPEG')
+
+                    self.wfile.write("--jpgboundary".encode())
+                    self.send_header('Content-type','image/jpeg')
+                    self.send_header('Content-length',str(tmpFile.getbuffer().nbytes))
+                    self.end_headers()
+                    self.wfile.write(tmpFile.getbuffer())
+
+                time.sleep(0.1)
+
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                print(e)
+                raise e
+
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
@@ -57,6 +64,8 @@ class MjpgStreamServer:
 
     def __init__(self, host='0.0.0.0', port=8080):
         self._frame = None
+        self._clients = 0
+        self.mutex = threading.RLock()
 
         self.server = ThreadedHTTPServer((host, port), CamHandler)
         self.server.main = self
@@ -67,7 +76,19 @@ class MjpgStreamServer:
         self.thread.daemon = True
         self.thread.start()
 
-        self.mutex = threading.RLock()
+    @property
+    def clients(self):
+        """Number of connected MJPEG stream clients"""
+        with self.mutex:
+            return self._clients
+
+    def client_connected(self):
+        with self.mutex:
+            self._clients += 1
+
+    def client_disconnected(self):
+        with self.mutex:
+            self._clients -= 1
 
     def get_frame(self):
         with self.mutex:
@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import os
 import time
 import paho.mqtt.client
 import click
 import click_log
 import logging
-from collections import deque
 from imutils.video import VideoStream
 import numpy as np
 import cv2
-import imutils
 import time
 import sys
 import json
+from functools import partial
 from mjpg_stream_server import MjpgStreamServer
+from vision_pipeline import LatestQueue, RateGovernor, Source, Stage, FrameScaler, FreshFrames, ProcessPool, request_width
+from tracking import BallDetector, KalmanFilter, RegionOfInterest, TrackerState, ball_locator
 
 logging.basicConfig(format='%(asctime)s %(message)s')
 
@@ -28,17 +30,31 @@ def mqtt_on_disconnect(mqttc, userdata, rc):
 
 @click.command()
 @click.option('--video', required=True, help='Video stream number', default=0, type=int)
-@click.option('--fps', required=True, help='Video stream fps', default=10, type=int)
-@click.option('--deque-len', required=True, help='Deque lenngth', default=10, type=int)
+@click.option('--fps', required=True, help='Processed frames per second, 0 for as fast as possible', default=10, type=int)
+@click.option('--deque-len', required=True, help='Trail length in frames', default=10, type=click.IntRange(2))
+@click.option('--width', default=600, type=click.IntRange(16), help='Streamed frame width, published coordinates are in this space [default: 600]')
+@click.option('--process-width', default=0, type=click.IntRange(0), help='Detection frame width, 0 for the streamed width [default: 0]')
+@click.option('--roi/--no-roi', default=True, help='Search only around the last known position [default: yes]')
+@click.option('--roi-misses', default=5, type=click.IntRange(1), help='Misses before searching the whole frame again [default: 5]')
+@click.option('--kalman', default='none', type=click.Choice(('none', ) + KalmanFilter.MODELS), help='Filter positions with a constant velocity or acceleration model [default: none]')
+@click.option('--predict-ms', default=100, type=click.IntRange(0), help='Publish the position expected this far ahead of capture, with --kalman [default: 100]')
+@click.option('--coast-ms', default=300, type=click.IntRange(0), help='Keep publishing predictions this long after losing the ball, with --kalman [default: 300]')
+@click.option('--workers', default=0, type=click.IntRange(0), help='Detect in this many worker processes, 0 to detect in process [default: 0]')
+@click.option('--display/--no-display', default=bool(os.environ.get('DISPLAY')), help='Show the annotated frame and mask in local windows [default: when DISPLAY is set]')
 @click.option('--host', 'mqtt_host', type=click.STRING, default="127.0.0.1", help="MQTT host to connect to [default: 127.0.0.1].")
 @click.option('--port', 'mqtt_port', type=click.IntRange(0, 65535), default=1883, help="MQTT port to connect to [default: 1883].")
 @click_log.simple_verbosity_option(default='INFO')
-def run(video, fps, deque_len, mqtt_host, mqtt_port):
+def run(video, fps, deque_len, width, process_width, roi, roi_misses, kalman, predict_ms, coast_ms, workers, display, mqtt_host, mqtt_port):
     logging.info("Process started")
 
     http = MjpgStreamServer()
 
-    vs = VideoStream(src=video).start()
+    vs = VideoStream(src=video)
+    request_width(vs, width)
+    vs.start()
+
+    scaler = FrameScaler(width, process_width)
+    logging.info('Detection at %d px, output at %d px', scaler.process_width, scaler.width)
 
     # bgr = [31,25,62]
     # thresh = 40
@@ -51,10 +67,11 @@ def run(video, fps, deque_len, mqtt_host, mqtt_port):
     minHSV = np.array([165, 132, 98])
     maxHSV = np.array([195, 255,  255])
 
-    pts = deque(maxlen=deque_len)
-    counter = 0
-    (dX, dY) = (0, 0)
-    direction = ""
+    detector = BallDetector(minHSV, maxHSV)
+    roi = RegionOfInterest(roi_misses) if roi else None
+
+    state = TrackerState(deque_len)
+    kalman = KalmanFilter(kalman) if kalman != 'none' else None
 
     mqttc = paho.mqtt.client.Client(userdata={})
     mqttc.on_connect = mqtt_on_connect
@@ -65,86 +82,198 @@ def run(video, fps, deque_len, mqtt_host, mqtt_port):
 
     time.sleep(2.0)
 
-    logging.info('Loop start')
-    while True:
-
-        time.sleep(0.1)
-        frame = vs.read()
-
-        frame = imutils.resize(frame, width=600)
-
-        # print(frame[200][200])
-        # cv2.circle(frame,(200,200), 20, (255,0,0), 1)
-        # cv2.imshow("frame", frame)
-
-        blurred = cv2.GaussianBlur(frame, (11, 11), 0)
-        hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
-
-        mask = cv2.inRange(hsv, minHSV, maxHSV)
-        cv2.imshow("mask", mask)
-
-        mask = cv2.erode(mask, None, iterations=2)
-        # cv2.imshow("erode", mask)
-        mask = cv2.dilate(mask, None, iterations=2)
-        # cv2.imshow("dilate", mask)
-
-        cnts = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cnts = imutils.grab_contours(cnts)
-        center = None
-
-        if len(cnts) > 0:
-            c = max(cnts, key=cv2.contourArea)
-            ((x, y), radius) = cv2.minEnclosingCircle(c)
-            M = cv2.moments(c)
-            center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-
-            if radius > 10:
-                cv2.circle(frame, (int(x), int(y)), int(radius), (0, 255, 255), 2)
-                cv2.circle(frame, center, 5, (0, 0, 255), -1)
-
-        pts.appendleft(center)
-
-        for i in np.arange(1, len(pts)):
-
-            if pts[i - 1] is None or pts[i] is None:
-                continue
-
-            if counter >= 10 and i == 1 and len(pts) > 9 and pts[-10] is not None:
-                dX = pts[-10][0] - pts[i][0]
-                dY = pts[-10][1] - pts[i][1]
-                (dirX, dirY) = ("", "")
-
-                if np.abs(dX) > 20:
-                    dirX = "East" if np.sign(dX) == 1 else "West"
-
-                if np.abs(dY) > 20:
-                    dirY = "North" if np.sign(dY) == 1 else "South"
-
-                if dirX != "" and dirY != "":
-                    direction = "{}-{}".format(dirY, dirX)
-
-                else:
-                    direction = dirX if dirX != "" else dirY
+    detect_q = LatestQueue(1)
+    annotate_q = LatestQueue(1)
+    publish_q = LatestQueue(4 + 2 * workers)
+
+    frames = FreshFrames(vs)
+
+    def capture():
+        frame = frames.read()
+        if frame is None:
+            return None
+        return (time.monotonic(), ) + scaler(frame)
+
+    def detect(frames):
+        t, frame, small = frames
+        window = roi.window(small.shape) if roi else None
+
+        if window:
+            x0, y0, x1, y1 = window
+            center, xy, radius, mask = detector.detect(small[y0:y1, x0:x1])
+            if center:
+                center = (center[0] + x0, center[1] + y0)
+                xy = (xy[0] + x0, xy[1] + y0)
+        else:
+            center, xy, radius, mask = detector.detect(small)
+
+        if roi:
+            roi.update(center, radius)
+
+        return track(t, frame, window, center, xy, radius, mask)
+
+    def track(t, frame, window, center, xy, radius, mask):
+        # Back to output coordinates
+        ratio = scaler.ratio
+        if window:
+            window = tuple(int(v * ratio) for v in window)
+        if center:
+            center = (int(center[0] * ratio), int(center[1] * ratio))
+            xy = scaler.to_output(*xy)
+            radius *= ratio
+
+        circle = None
+        if center and radius > 10:
+            circle = ((int(xy[0]), int(xy[1])), int(radius))
+
+        state.update(t, center)
+
+        estimate = None
+        coasting = False
+        if kalman:
+            if center:
+                kalman.update(t, center)
+            else:
+                coasting = kalman.coast(t, coast_ms / 1000.0)
+            if kalman.initialized:
+                estimate = (kalman.position(), kalman.extrapolate(predict_ms / 1000.0))
+
+        result = {"center": center, "dx": state.dx, "dy": state.dy, "direction": state.direction,
+                  "estimate": estimate, "coasting": coasting}
+
+        # Overlays are only rendered when somebody looks at them
+        if frame is not None and (display or http.clients):
+            result.update({"frame": frame, "window": window, "circle": circle, "trail": state.trail(),
+                           # The detector reuses its mask buffer for the next frame
+                           "mask": mask.copy() if display and mask is not None else None})
+            annotate_q.put(result)
+
+        return result
+
+    def publish(result):
+        center = result["center"]
+        estimate = result["estimate"]
+        if not center and not estimate:
+            return
+
+        if estimate:
+            filtered, predicted = estimate
+            center = center or (round(filtered[0]), round(filtered[1]))
+
+        message = {"x": center[0], "y": center[1], "dx": result["dx"], "dy": result["dy"]}
+
+        if estimate:
+            message["filtered"] = {"x": round(filtered[0], 1), "y": round(filtered[1], 1)}
+            message["predicted"] = {"x": round(predicted[0], 1), "y": round(predicted[1], 1), "ms": predict_ms}
+            message["coasting"] = result["coasting"]
+
+        mqttc.publish("object/movement", json.dumps(message), qos=0)
+
+    def annotate(result):
+        # The captured frame may still be read by the camera thread or the detector
+        frame = result["frame"].copy()
+        trail = result["trail"]
+
+        if result["window"]:
+            x0, y0, x1, y1 = result["window"]
+            cv2.rectangle(frame, (x0, y0), (x1, y1), (255, 0, 0), 1)
+
+        if result["circle"]:
+            cv2.circle(frame, result["circle"][0], result["circle"][1], (0, 255, 255), 2)
+            cv2.circle(frame, result["center"], 5, (0, 0, 255), -1)
+
+        if result["estimate"]:
+            predicted = tuple(int(v) for v in result["estimate"][1])
+            cv2.drawMarker(frame, predicted, (255, 0, 255), cv2.MARKER_CROSS, 12, 2)
+
+        # Segments between two hits, misses are NaN
+        hit = ~np.isnan(trail[:, 1])
+        pts = np.nan_to_num(trail[:, 1:]).astype(int).tolist()
+        for i in np.flatnonzero(hit[1:] & hit[:-1]) + 1:
+            cv2.line(frame, pts[i - 1], pts[i], (0, 0, 255), int(state.thickness[i - 1]))
+
+        cv2.putText(frame, result["direction"], (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 0, 255), 3)
+        cv2.putText(frame, "dx: {}, dy: {}".format(result["dx"], result["dy"]), (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
 
-            thickness = int(np.sqrt(deque_len / float(i + 1)) * 2.5)
-            cv2.line(frame, pts[i - 1], pts[i], (0, 0, 255), thickness)
+        http.set_frame(frame)
+        return frame
+
+    pool = None
+
+    if workers:
+        # Frames are detected out of order in the workers, the pool hands them back in order for tracking
+        if roi:
+            logging.info('ROI search is not used with --workers')
+        shape = scaler(frames.read())[1].shape
+        pool = ProcessPool(partial(ball_locator, minHSV, maxHSV), shape, workers=workers)
+        sequenced_q = LatestQueue(16)
+
+        def capture_shared():
+            frame = frames.read()
+            if frame is None:
+                return None
+            t = time.monotonic()
+
+            def fill(dst):
+                output, _ = scaler(frame, dst)
+                return t, output if display or http.clients else None
+
+            pool.submit(fill)
+
+        def track_sequenced(batch):
+            for (t, frame), located in batch:
+                center, xy, radius = located or (None, None, 0)
+                publish_q.put(track(t, frame, None, center, xy, radius, None))
+
+        # capture -> workers -> collect -> track -> (publish, annotate when watched)
+        stages = [
+            Source('capture', capture_shared, RateGovernor(fps)),
+            Source('collect', pool.collect, RateGovernor(0), (sequenced_q, )),
+            Stage('track', track_sequenced, sequenced_q),
+            Stage('publish', publish, publish_q),
+        ]
+    else:
+        # capture -> detect -> (publish, annotate when watched), every queue keeps only the newest items
+        stages = [
+            Source('capture', capture, RateGovernor(fps), (detect_q, )),
+            Stage('detect', detect, detect_q, (publish_q, )),
+            Stage('publish', publish, publish_q),
+        ]
+    if not display:
+        stages.append(Stage('annotate', annotate, annotate_q))
 
-        cv2.putText(frame, direction, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 0, 255), 3)
-        cv2.putText(frame, "dx: {}, dy: {}".format(dX, dY), (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
+    logging.info('Loop start')
+    for stage in stages:
+        stage.start()
 
-        if center:
-            mqttc.publish("object/movement", json.dumps({"x": center[0], "y": center[1], "dx": dX, "dy": dY}), qos=0)
+    try:
+        while not display:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
 
+    # HighGUI windows have to be driven from the main thread
+    while display:
+        result = annotate_q.get(timeout=0.5)
+        if result is None:
+            continue
 
-        http.set_frame(frame)
-        counter += 1
+        frame = annotate(result)
 
+        if result["mask"] is not None:
+            cv2.imshow("mask", result["mask"])
         cv2.imshow("Frame", frame)
         key = cv2.waitKey(1) & 0xFF
 
         if key == ord("q"):
             break
 
+    for stage in stages:
+        stage.stop()
+
+    if pool:
+        pool.close()
+
     vs.stop()
 
     # cv2.destroyAllWindows()
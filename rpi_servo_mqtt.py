@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import pigpio
 import time
 import paho.mqtt.client
 import click
 import click_log
 import logging
+import json
+from threading import Lock, Thread
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
 
 PIN_HORIZONTAL = 17
 PIN_VERTICAL = 18
@@ -13,36 +18,317 @@ PIN_VERTICAL = 18
 logging.basicConfig(format='%(asctime)s %(message)s')
 
 
+class PigpioBackend():
+    """One pigpiod connection shared by all servos
+
+    Pulsewidths queued during a control tick are written by flush() in a
+    single pigpio script run, i.e. one socket round trip for all servos.
+    """
+
+    MAX_SCRIPT_PARAMS = 10
+
+    def __init__(self):
+        if pigpio is None:
+            raise Exception('pigpio is not installed')
+        self._pi = pigpio.pi()
+        if not self._pi.connected:
+            raise Exception('Could not connect to pigpiod')
+        self._lock = Lock()
+        self._pending = {}
+        self._scripts = {}
+        self._ready = set()
+
+    def set_servo_pulsewidth(self, pin, pulsewidth):
+        with self._lock:
+            self._pending.pop(pin, None)
+            self._pi.set_servo_pulsewidth(pin, pulsewidth)
+
+    def queue(self, pin, pulsewidth):
+        with self._lock:
+            self._pending[pin] = pulsewidth
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            pending = sorted(self._pending.items())
+            self._pending.clear()
+
+            for i in range(0, len(pending), self.MAX_SCRIPT_PARAMS):
+                self._write(pending[i:i + self.MAX_SCRIPT_PARAMS])
+
+    def _write(self, pending):
+        if len(pending) > 1:
+            pins = tuple(pin for pin, _ in pending)
+            script = self._script(pins)
+            if script is not None:
+                try:
+                    self._pi.run_script(script, [pulsewidth for _, pulsewidth in pending])
+                    return
+                except pigpio.error as e:
+                    logging.debug("Script for pins %s failed: %s", pins, e)
+                    # Check its status again before the next run
+                    self._ready.discard(script)
+
+        for pin, pulsewidth in pending:
+            self._pi.set_servo_pulsewidth(pin, pulsewidth)
+
+    def _script(self, pins):
+        script = self._scripts.get(pins)
+        if script is None:
+            code = ' '.join('s %d p%d' % (pin, i) for i, pin in enumerate(pins))
+            try:
+                script = self._pi.store_script(code.encode())
+            except pigpio.error as e:
+                logging.warning("Could not store servo script: %s", e)
+                script = False
+            self._scripts[pins] = script
+        if script is False:
+            return None
+        if script in self._ready:
+            return script
+        # Freshly stored scripts are not runnable until pigpiod initialised them,
+        # asked only until then as every status query is another round trip
+        if self._pi.script_status(script)[0] == pigpio.PI_SCRIPT_INITING:
+            return None
+        self._ready.add(script)
+        return script
+
+
+class FakeBackend():
+    """Backend recording writes instead of driving GPIO, for tests and benchmarks"""
+
+    def __init__(self):
+        self._pending = {}
+        self.pulsewidths = {}
+        self.writes = 0
+        self.round_trips = 0
+
+    def set_servo_pulsewidth(self, pin, pulsewidth):
+        self._pending.pop(pin, None)
+        self.pulsewidths[pin] = pulsewidth
+        self.writes += 1
+        self.round_trips += 1
+
+    def queue(self, pin, pulsewidth):
+        self._pending[pin] = pulsewidth
+
+    def flush(self):
+        if not self._pending:
+            return
+        self.pulsewidths.update(self._pending)
+        self.writes += len(self._pending)
+        self.round_trips += 1
+        self._pending.clear()
+
+
+BACKENDS = {
+    'pigpio': PigpioBackend,
+    'fake': FakeBackend,
+}
+
+_shared_backend = None
+
+
+def shared_backend():
+    global _shared_backend
+    if _shared_backend is None:
+        _shared_backend = PigpioBackend()
+    return _shared_backend
+
+
 class Servo():
-    def __init__(self, pin, min_pulsewidth=500, max_pulsewidth=2500):
+    def __init__(self, pin, min_pulsewidth=500, max_pulsewidth=2500, backend=None):
         self._pin = pin
         self._min_pulsewidth = min_pulsewidth
         self._max_pulsewidth = max_pulsewidth
         self._angle = None
-        self._gpio = pigpio.pi()
+        self._position = None
+        self._velocity = 0.0
+        self._pulsewidth = None
+        self._gpio = backend or shared_backend()
         self.off()
 
     def __del__(self):
         self.off()
         time.sleep(0.02)
-    
-    def set_angle(self, angle):
+
+    def _clamp(self, angle):
         if angle > 180:
-            angle = 180
-        elif  angle < 0:
-            angle = 0
+            return 180
+        elif angle < 0:
+            return 0
+        return angle
 
-        pulsewidth = ((self._max_pulsewidth - self._min_pulsewidth) * (angle / 180.0)) + self._min_pulsewidth
+    def _write(self, angle, batch=False):
+        pulsewidth = int(round(((self._max_pulsewidth - self._min_pulsewidth) * (angle / 180.0)) + self._min_pulsewidth))
 
-        self._gpio.set_servo_pulsewidth(self._pin, pulsewidth)
+        if pulsewidth != self._pulsewidth:
+            if batch:
+                self._gpio.queue(self._pin, pulsewidth)
+            else:
+                self._gpio.set_servo_pulsewidth(self._pin, pulsewidth)
+            self._pulsewidth = pulsewidth
+
+    def set_angle(self, angle):
+        angle = self._clamp(angle)
+
+        self._write(angle)
 
         self._angle = angle
+        self._position = angle
+        self._velocity = 0.0
+
+    def move_to(self, angle):
+        """Set target for the MotionScheduler, the servo is moved on its next ticks"""
+        self._angle = self._clamp(angle)
 
     def get_angle(self):
         return self._angle
-        
+
+    def step(self, dt, max_velocity, max_acceleration):
+        """Advance toward the target by one control tick, return True while moving"""
+        if self._angle is None:
+            return False
+
+        if self._position is None:
+            self.set_angle(self._angle)
+            return False
+
+        error = self._angle - self._position
+        if error == 0 and self._velocity == 0:
+            return False
+
+        # Fastest speed that still allows braking to zero at the target
+        desired = min(max_velocity, (2 * max_acceleration * abs(error)) ** 0.5)
+        desired = desired if error > 0 else -desired
+
+        dv = max(-max_acceleration * dt, min(max_acceleration * dt, desired - self._velocity))
+        self._velocity += dv
+        self._position += self._velocity * dt
+
+        if (self._angle - self._position) * error <= 0:
+            self._position = self._angle
+            self._velocity = 0.0
+
+        self._write(self._position, batch=True)
+        return True
+
     def off(self):
         self._gpio.set_servo_pulsewidth(self._pin, 0)
+        self._pulsewidth = 0
+
+
+class MotionScheduler():
+    """Move servos toward their targets at a fixed control rate
+
+    The default 50 Hz matches the 20 ms servo PWM period, so at most one new
+    pulsewidth is written per servo per pulse and only when it changes.
+    """
+
+    def __init__(self, servos, rate=50, max_velocity=300.0, max_acceleration=1500.0, backend=None):
+        self._servos = list(servos)
+        self._backend = backend or shared_backend()
+        self._period = 1.0 / rate
+        self._max_velocity = max_velocity
+        self._max_acceleration = max_acceleration
+        self.is_run = False
+
+    def tick(self):
+        """Step every servo once and write the changed pulsewidths together"""
+        for servo in self._servos:
+            servo.step(self._period, self._max_velocity, self._max_acceleration)
+        self._backend.flush()
+
+    def run(self):
+        self.is_run = True
+        next_tick = time.monotonic()
+        while self.is_run:
+            self.tick()
+
+            next_tick += self._period
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Missed ticks are dropped instead of being caught up in a burst
+                next_tick = time.monotonic()
+
+    def start(self):
+        """Run in thread"""
+        thread = Thread(target=self.run, args=[])
+        thread.daemon = True
+        thread.start()
+
+
+class PID():
+    def __init__(self, kp, ki=0.0, kd=0.0, deadband=0.0, integral_limit=30.0):
+        self._kp = kp
+        self._ki = ki
+        self._kd = kd
+        self._deadband = deadband
+        self._integral_limit = integral_limit
+        self.reset()
+
+    def reset(self):
+        self._integral = 0.0
+        self._error = None
+
+    def update(self, error, dt):
+        if abs(error) <= self._deadband:
+            error = 0.0
+
+        self._integral += error * dt
+        self._integral = max(-self._integral_limit, min(self._integral_limit, self._integral))
+
+        derivative = 0.0
+        if self._error is not None and dt > 0:
+            derivative = (error - self._error) / dt
+        self._error = error
+
+        return self._kp * error + self._ki * self._integral + self._kd * derivative
+
+
+class PanTiltTracker():
+    """Keep the tracked object at the frame center by steering the pan/tilt servos
+
+    Each object/movement position is fed to one PID per axis, whose output is
+    an angular velocity in deg/s. It is integrated over the time since the
+    previous position, so the loop gain does not depend on the frame rate.
+    """
+
+    def __init__(self, horizontal, vertical, center=(290, 195), kp=0.2, ki=0.0, kd=0.02, deadband=10, timeout=0.5):
+        self._horizontal = horizontal
+        self._vertical = vertical
+        self._center = center
+        self._pid_x = PID(kp, ki, kd, deadband)
+        self._pid_y = PID(kp, ki, kd, deadband)
+        self._timeout = timeout
+        self._last = None
+
+    def update(self, x, y, move=True):
+        now = time.monotonic()
+        dt = now - self._last if self._last is not None else 0.0
+        self._last = now
+
+        # A lost object must not leave stale integral or derivative state behind
+        if dt > self._timeout:
+            self._pid_x.reset()
+            self._pid_y.reset()
+            dt = 0.0
+
+        # Object right of center pans up the angle, object above center tilts up the angle
+        step_x = self._pid_x.update(x - self._center[0], dt) * dt
+        step_y = -self._pid_y.update(y - self._center[1], dt) * dt
+
+        for servo, step in ((self._horizontal, step_x), (self._vertical, step_y)):
+            if step:
+                angle = servo.get_angle()
+                angle = (90 if angle is None else angle) + step
+                if move:
+                    servo.move_to(angle)
+                else:
+                    servo.set_angle(angle)
 
 
 def mqtt_on_connect(mqttc, userdata, flags, rc):
@@ -55,6 +341,9 @@ def mqtt_on_connect(mqttc, userdata, flags, rc):
         logging.debug('Subscribe: %s', topic)
         mqttc.subscribe(topic)
 
+    if userdata.get('tracker'):
+        mqttc.subscribe('object/movement')
+
 
 def mqtt_on_disconnect(mqttc, userdata, rc):
     logging.info('Disconnect from MQTT broker with code %s', rc)
@@ -63,16 +352,28 @@ def mqtt_on_disconnect(mqttc, userdata, rc):
 def mqtt_on_message(mqttc, userdata, message):
     logging.debug('Message %s %s', message.topic, message.payload)
 
+    if message.topic == 'object/movement':
+        try:
+            payload = json.loads(message.payload.decode())
+            # Aim where a Kalman filtering tracker expects the object to be by now
+            position = payload.get('predicted') or payload
+            userdata['tracker'].update(position['x'], position['y'], move=bool(userdata.get('scheduler')))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning('Invalid object/movement %s: %s', message.payload, e)
+        return
+
     servo = userdata.get(message.topic[6], None)
 
     if not servo:
         return
 
+    move = servo.move_to if userdata.get('scheduler') else servo.set_angle
+
     if message.topic == 'servo/vertical/angle/set':
-        servo.set_angle(int(message.payload))
-        
+        move(int(message.payload))
+
     elif message.topic == 'servo/horizontal/angle/set':
-        servo.set_angle(int(message.payload))
+        move(int(message.payload))
 
     mqttc.publish(message.topic[:-4], servo.get_angle())
 
@@ -85,14 +386,34 @@ def mqtt_on_message(mqttc, userdata, message):
 @click.option('--cafile', type=click.Path(exists=True), help="MQTT cafile.")
 @click.option('--certfile', type=click.Path(exists=True), help="MQTT certfile.")
 @click.option('--keyfile', type=click.Path(exists=True), help="MQTT keyfile.")
+@click.option('--rate', type=click.IntRange(0, 500), default=50, help="Motion control rate in Hz, 0 moves servos immediately [default: 50].")
+@click.option('--max-velocity', type=float, default=300.0, help="Servo velocity limit in deg/s [default: 300].")
+@click.option('--max-acceleration', type=float, default=1500.0, help="Servo acceleration limit in deg/s^2 [default: 1500].")
+@click.option('--backend', type=click.Choice(BACKENDS), default='pigpio', help="Servo backend, fake runs without GPIO [default: pigpio].")
+@click.option('--track', is_flag=True, help="Follow object/movement with the pan/tilt head in process.")
+@click.option('--track-center', type=(int, int), default=(290, 195), help="Frame position the object is held at [default: 290 195].")
+@click.option('--track-pid', type=(float, float, float), default=(0.2, 0.0, 0.02), help="Tracking PID gains in deg/s per px [default: 0.2 0 0.02].")
+@click.option('--track-deadband', type=float, default=10, help="Tracking error in px ignored around the center [default: 10].")
 @click_log.simple_verbosity_option(default='INFO')
-def run(host, port, username, password, cafile, certfile, keyfile):
+def run(host, port, username, password, cafile, certfile, keyfile, rate, max_velocity, max_acceleration, backend, track, track_center, track_pid, track_deadband):
     logging.info("Process started")
 
-    horizontal = Servo(PIN_HORIZONTAL)
-    vertical = Servo(PIN_VERTICAL)
+    backend = BACKENDS[backend]()
+
+    horizontal = Servo(PIN_HORIZONTAL, backend=backend)
+    vertical = Servo(PIN_VERTICAL, backend=backend)
+
+    scheduler = None
+    if rate:
+        scheduler = MotionScheduler((horizontal, vertical), rate, max_velocity, max_acceleration, backend)
+        scheduler.start()
+
+    tracker = None
+    if track:
+        kp, ki, kd = track_pid
+        tracker = PanTiltTracker(horizontal, vertical, track_center, kp, ki, kd, track_deadband)
 
-    mqttc = paho.mqtt.client.Client(userdata={"h": horizontal, "v": vertical})
+    mqttc = paho.mqtt.client.Client(userdata={"h": horizontal, "v": vertical, "scheduler": scheduler, "tracker": tracker})
     mqttc.on_connect = mqtt_on_connect
     mqttc.on_message = mqtt_on_message
     mqttc.on_disconnect = mqtt_on_disconnect
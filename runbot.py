@@ -5,14 +5,14 @@ import paho.mqtt.client
 import click
 import click_log
 import logging
-from collections import deque
 from imutils.video import VideoStream
 import numpy as np
 import cv2
-import imutils
 import time
 import sys
 import json
+from vision_pipeline import LatestQueue, RateGovernor, Source, Stage, FrameScaler, FreshFrames, request_width
+from tracking import ColorSegmenter, MultiTracker, filter_components
 
 logging.basicConfig(format='%(asctime)s %(message)s')
 
@@ -27,15 +27,25 @@ def mqtt_on_disconnect(mqttc, userdata, rc):
 
 @click.command()
 @click.option('--video', required=True, help='Video stream number', default=0, type=int)
-@click.option('--fps', required=True, help='Video stream fps', default=10, type=int)
-@click.option('--deque-len', required=True, help='Deque lenngth', default=32, type=int)
+@click.option('--fps', required=True, help='Processed frames per second, 0 for as fast as possible', default=10, type=int)
+@click.option('--width', default=600, type=click.IntRange(16), help='Frame width published coordinates are in [default: 600]')
+@click.option('--process-width', default=0, type=click.IntRange(0), help='Detection frame width, 0 for --width [default: 0]')
+@click.option('--track-distance', default=80, type=float, help='Largest move in px between frames still matched to a track [default: 80]')
+@click.option('--track-misses', default=5, type=click.IntRange(0), help='Frames a track survives without a match [default: 5]')
 @click.option('--host', 'mqtt_host', type=click.STRING, default="127.0.0.1", help="MQTT host to connect to [default: 127.0.0.1].")
 @click.option('--port', 'mqtt_port', type=click.IntRange(0, 65535), default=1883, help="MQTT port to connect to [default: 1883].")
 @click_log.simple_verbosity_option(default='INFO')
-def run(video, fps, deque_len, mqtt_host, mqtt_port):
+def run(video, fps, width, process_width, track_distance, track_misses, mqtt_host, mqtt_port):
     logging.info("Process started")
 
-    vs = VideoStream(src=video).start()
+    vs = VideoStream(src=video)
+    request_width(vs, width)
+    vs.start()
+
+    scaler = FrameScaler(width, process_width)
+    # Blob area limits are given at 600 px
+    min_area = 300 * (width / 600.0 / scaler.ratio) ** 2
+    max_area = 10000 * (width / 600.0 / scaler.ratio) ** 2
  
     bgr = [31,25,62]
     thresh = 40
@@ -47,10 +57,6 @@ def run(video, fps, deque_len, mqtt_host, mqtt_port):
     minHSV = np.array([165, 132, 98])
     maxHSV = np.array([195, 255,  255])
 
-    pts = deque(maxlen=deque_len)
-    counter = 0
-    (dX, dY) = (0, 0)
-    direction = ""
  
     mqttc = paho.mqtt.client.Client(userdata={})
     mqttc.on_connect = mqtt_on_connect
@@ -59,48 +65,49 @@ def run(video, fps, deque_len, mqtt_host, mqtt_port):
     mqttc.connect(mqtt_host, mqtt_port, keepalive=10)
     mqttc.loop_start()
 
-    time.sleep(2.0)
+    segmenter = ColorSegmenter(minHSV, maxHSV, blur=3, erode=2, dilate=0)
+    tracker = MultiTracker(track_distance, track_misses)
 
-    logging.info('Loop start')
+    time.sleep(2.0)
 
-    counter = 0
+    detect_q = LatestQueue(1)
+    publish_q = LatestQueue(4)
 
-    while True:
+    frames = FreshFrames(vs)
 
-        logging.info("Frame read")
-        time.sleep(0.05)
-        frame = vs.read()
+    def capture():
+        logging.debug("Frame read")
+        frame = frames.read()
+        if frame is None:
+            return None
         #time.sleep(1)
 
+        return time.monotonic(), scaler.process(frame)
 
-        frame = imutils.resize(frame, width=600)
+    def detect(frames):
         #cv2.imwrite(str(round(time.time())) + '.jpg',  frame )
         # print(frame[200][200])
         # cv2.circle(frame,(200,200), 20, (255,0,0), 1)
         # cv2.imshow("frame", frame)
 
-        blurred = cv2.GaussianBlur(frame, (3, 3), 0)
-        hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
+        t, frame = frames
 
-        mask = cv2.inRange(hsv, minHSV, maxHSV)
+        mask, eroded = segmenter.segment(frame)
         # cv2.imshow("mask", mask)
 
-        mask = cv2.erode(mask, None, iterations=2)
-        #mask = cv2.dilate(mask, None, iterations=2)
-        connectivity = 4 
-        output = cv2.connectedComponentsWithStats(mask, connectivity, cv2.CV_32S)
-        centroids = output[3]
+        connectivity = 4
+        output = cv2.connectedComponentsWithStats(eroded, connectivity, cv2.CV_32S)
 
+        centroids, areas = filter_components(output[2], output[3], min_area, max_area)
+        tracks = tracker.update(t, centroids * scaler.ratio, areas * scaler.ratio ** 2)
 
-        ball_index = -1
-        for i in range( len(output[2]) ):
-            
-            if 10000 > output[2][i][4] >300:
-                ball_index = i
-
-        if ball_index != -1:
-            print(centroids[ball_index])
-            mqttc.publish("object/movement", json.dumps({"x": round(centroids[ball_index][0]), "y": round(centroids[ball_index][1]), "dx": dX, "dy": dY}), qos=0)
+        if tracks:
+            logging.debug("Tracks %s", [(track.id, track.x, track.y) for track in tracks])
+            # Longest living track first, its position stays at the top level for single target consumers
+            movement = [track.as_dict() for track in tracks]
+            message = dict(movement[0])
+            message["tracks"] = movement
+            return message
 
 
 
@@ -164,6 +171,29 @@ def run(video, fps, deque_len, mqtt_host, mqtt_port):
 
     
         '''
+
+    def publish(movement):
+        mqttc.publish("object/movement", json.dumps(movement), qos=0)
+
+    stages = [
+        Source('capture', capture, RateGovernor(fps), (detect_q, )),
+        Stage('detect', detect, detect_q, (publish_q, )),
+        Stage('publish', publish, publish_q),
+    ]
+
+    logging.info('Loop start')
+    for stage in stages:
+        stage.start()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    for stage in stages:
+        stage.stop()
+
     vs.stop()
  
     cv2.destroyAllWindows()
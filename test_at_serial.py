@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import time
+from threading import Thread
+import pytest
+import serial
+from at_device_sim import DeviceSimulator
+from at_serial import ATSerial, ATTimeout, ATDisconnected, BinaryCodec, crc8
+
+
+def stop_reader(at):
+    at.is_run = False
+    time.sleep(0.2)
+    at._close()
+
+
+class Sim(DeviceSimulator):
+    """Simulator recording the command lines it handled, with optional per-command delays"""
+
+    def __init__(self, delays=None, **kwargs):
+        super().__init__(**kwargs)
+        self.delays = delays or {}
+        self.lines = []
+        self.swallow = set()
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def _handle(self, line):
+        self.lines.append(line)
+        time.sleep(self.delays.get(line, 0))
+        if line in self.swallow:
+            return
+        super()._handle(line)
+
+    def stop(self):
+        if not self._thread.is_alive():
+            return
+        self.is_run = False
+        # Wake select() in run(), whatever is written on the slave side is read from the master
+        os.write(self._slave, b'\r\n')
+        self._thread.join(2)
+        self.close()
+
+
+@pytest.fixture
+def sim():
+    sim = Sim()
+    yield sim
+    sim.stop()
+
+
+@pytest.fixture
+def at(sim):
+    at = ATSerial(sim.device, pipeline=4, timeout=2, backoff=(0.01, 0.05))
+    at.start()
+    yield at
+    stop_reader(at)
+
+
+def test_responses_match_commands_in_order(sim, at):
+    for n in range(1, 5):
+        assert at.command('$S%d=%d' % (n, n * 10)) == []
+
+    queries = ['$S4?', '$S1?', '$S3?', '$S2?', '$S1?', '$S4?']
+    futures = [at.command_async(query) for query in queries]
+
+    assert [future.result(2) for future in futures] == [['+%s: %d' % (query[1:3], int(query[2]) * 10)] for query in queries]
+    assert all(future.rtt > 0 for future in futures)
+
+
+def test_error_response_resolves_none(sim, at):
+    assert at.command_async('$NOPE').result(2) is None
+    assert at.command_async('$S1?').result(2) == ['+S1: 0']
+
+
+def test_expired_request_absorbs_late_response(sim, at):
+    sim.delays[b'AT$S1?'] = 0.3
+    at.command('$S2=7')
+
+    late = at.command_async('$S1?', timeout=0.2)
+    behind = at.command_async('$S2?')
+
+    with pytest.raises(ATTimeout):
+        late.result(2)
+    # The late +S1 answer went to the expired request, not to the one behind it
+    assert behind.result(2) == ['+S2: 7']
+
+
+def test_lost_response_does_not_shift_later_ones(sim, at):
+    for n in (1, 2, 3):
+        at.command('$S%d=%d' % (n, n * 11))
+    sim.swallow.add(b'AT$STOP')
+
+    stop = at.command_async('$STOP')
+    queries = [at.command_async('$S%d?' % n) for n in (1, 2, 3)]
+
+    assert [query.result(2) for query in queries] == [['+S1: 11'], ['+S2: 22'], ['+S3: 33']]
+    # Never acknowledged, so never reported as applied
+    with pytest.raises(ATTimeout):
+        stop.result(0)
+
+
+def test_nothing_is_sent_behind_an_expired_request(sim, at):
+    sim.swallow.add(b'AT$FORWARD=1,1')
+    first = at.command_async('$FORWARD=1,1', timeout=0.2)
+    second = at.command_async('$FORWARD=2,2', timeout=0.2)
+
+    # Plain OK replies cannot be told apart, the second one's completes the first
+    assert first.result(2) == []
+    with pytest.raises(ATTimeout):
+        second.result(2)
+
+    # Held back until the expired request stops waiting for a reply, so it gets its own
+    assert at.command_async('$STOP').result(2) == []
+    assert at.command_async('$S1?').result(2) == ['+S1: 0']
+
+
+def test_urgent_command_cancels_queued(sim):
+    sim.delays[b'AT$FORWARD=1,1'] = 0.2
+    at = ATSerial(sim.device, pipeline=1, timeout=2)
+    at.start()
+    try:
+        sent = at.command_async('$FORWARD=1,1')
+        queued = [at.command_async('$FORWARD=%d,%d' % (n, n)) for n in (2, 3)]
+        stop = at.command_async('$STOP', urgent=True)
+
+        assert all(future.cancelled() for future in queued)
+        assert sent.result(2) == []
+        assert stop.result(2) == []
+        time.sleep(0.1)
+        assert sim.lines == [b'AT$FORWARD=1,1', b'AT$STOP']
+    finally:
+        stop_reader(at)
+
+
+def test_lost_device_fails_pending_and_new_commands(sim, at):
+    sim.swallow.add(b'AT$S1?')
+    pending = at.command_async('$S1?')
+    deadline = time.monotonic() + 2
+    while b'AT$S1?' not in sim.lines and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # The pty disappears with the simulator, reconnecting keeps failing
+    sim.stop()
+
+    with pytest.raises(ATDisconnected):
+        pending.result(2)
+    with pytest.raises(ATDisconnected):
+        at.command_async('$S2?').result(0)
+
+
+def test_cached_query_is_invalidated_by_write(sim, at):
+    at.cache.declare('$S', 10)
+
+    assert at.command('$S1?') == ['+S1: 0']
+    handled = len(sim.lines)
+    hit = at.command_async('$S1?')
+    assert hit.result(0) == ['+S1: 0']
+    assert hit.rtt == 0
+    assert len(sim.lines) == handled
+
+    assert at.command('$S1=5') == []
+    assert at.command('$S1?') == ['+S1: 5']
+    assert sim.lines[-1] == b'AT$S1?'
+
+    # Other commands are not affected by the write
+    assert at.command('$S2?') == ['+S2: 0']
+    assert at.command_async('$S2?').rtt == 0
+
+
+def test_reconnect_replays_link_setup_before_other_traffic(sim):
+    sim.delays[b'AT$BAUD=230400'] = 0.2
+    at = ATSerial(sim.device, resync=['$STOP'], backoff=(0.01, 0.05))
+    at.start()
+    try:
+        assert at.set_baudrate(230400).result(2)
+        assert at.enable_binary().result(2)
+
+        loop = at._loop
+
+        def hang_up():
+            at._loop = loop
+            raise OSError(5, 'Input/output error')
+
+        sim.lines.clear()
+        at._loop = hang_up
+        deadline = time.monotonic() + 2
+        while not sim.lines and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # The device is switching speed, nothing else may go out
+        with pytest.raises(ATDisconnected):
+            at.command_async('$S1?').result(0)
+
+        while at._replaying and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert at.command_async('$S1?').result(2) == ['+S1: 0']
+        assert sim.lines == [b'AT$BAUD=230400', b'AT$BIN=1', b'AT$STOP', b'AT$S1?']
+        assert at._baudrate == 230400 and at._binary
+    finally:
+        stop_reader(at)
+
+
+@pytest.mark.parametrize('command', ['$STOP', '$S1=90', '$S12=65535', '$FORWARD=1000,100', '$BACKWARD=0,0', '$LEFT=5,6', '$RIGHT=65535,1'])
+def test_binary_frame_round_trip(command):
+    frame = BinaryCodec().encode(command)
+    assert frame[0] == BinaryCodec.START
+    assert BinaryCodec().decode(frame + b'AT') == (command, len(frame))
+    assert BinaryCodec().decode(frame[:-1]) == (None, 0)
+
+
+@pytest.mark.parametrize('command', ['$S1?', '$S1=65536', '$S256=1', '$FORWARD=1', '$FORWARD=-1,1', '$BIN=1', ''])
+def test_commands_without_binary_form_stay_text(command):
+    assert BinaryCodec().encode(command) is None
+
+
+def test_bad_binary_frames_raise_value_error():
+    codec = BinaryCodec()
+    frame = bytearray(codec.encode('$S1=90'))
+    frame[3] ^= 0x01
+    with pytest.raises(ValueError):
+        codec.decode(frame)
+
+    # Valid CRC, but the payload does not fit the opcode
+    head = bytes((2, 0x10, 1))
+    with pytest.raises(ValueError):
+        codec.decode(bytes((BinaryCodec.START, )) + head + bytes((crc8(head), )))
+
+    head = bytes((1, 0x7f))
+    with pytest.raises(ValueError):
+        codec.decode(bytes((BinaryCodec.START, )) + head + bytes((crc8(head), )))
+
+
+def test_simulator_answers_bad_frames_with_error(sim):
+    port = serial.Serial(sim.device, timeout=1)
+    try:
+        port.write(b'AT$BIN=1\r\n')
+        assert port.readline() == b'OK\r\n'
+
+        codec = BinaryCodec()
+        bad_crc = bytearray(codec.encode('$S1=90'))
+        bad_crc[-1] ^= 0xff
+        head = bytes((2, 0x10, 1))
+        bad_length = bytes((BinaryCodec.START, )) + head + bytes((crc8(head), ))
+        port.write(bytes(bad_crc) + bad_length + codec.encode('$S2=45'))
+
+        assert [port.readline() for _ in range(3)] == [b'ERROR\r\n', b'ERROR\r\n', b'OK\r\n']
+        assert sim.state == {'S2': 45}
+    finally:
+        port.close()
+
+
+def test_binary_framing_against_simulator(sim, at):
+    assert at.enable_binary().result(2) is True
+    written = []
+    write = at._ser.write
+    at._ser.write = lambda data: written.append(bytes(data)) or write(data)
+
+    assert at.command('$S1=90') == []
+    assert at.command('$FORWARD=300,20') == []
+    # Queries and out of range values have no frame and go out as text AT
+    assert at.command('$S1=70000') == []
+    assert at.command('$S1?') == ['+S1: 70000']
+
+    codec = BinaryCodec()
+    assert written == [codec.encode('$S1=90'), codec.encode('$FORWARD=300,20'), b'AT$S1=70000\r\n', b'AT$S1?\r\n']
+    assert sim.lines[-4:] == [b'AT$S1=90', b'AT$FORWARD=300,20', b'AT$S1=70000', b'AT$S1?']
+
+
+def test_binary_falls_back_to_text():
+    sim = Sim(binary=False)
+    at = ATSerial(sim.device)
+    at.start()
+    try:
+        assert at.enable_binary().result(2) is False
+        assert at.command('$S1=90') == []
+        assert at.command('$S1?') == ['+S1: 90']
+    finally:
+        stop_reader(at)
+        sim.stop()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from rpi_servo_mqtt import FakeBackend, MotionScheduler, Servo, PIN_HORIZONTAL, PIN_VERTICAL
+
+
+def pan_tilt():
+    backend = FakeBackend()
+    horizontal = Servo(PIN_HORIZONTAL, backend=backend)
+    vertical = Servo(PIN_VERTICAL, backend=backend)
+    horizontal.set_angle(90)
+    vertical.set_angle(90)
+    return backend, horizontal, vertical, MotionScheduler([horizontal, vertical], backend=backend)
+
+
+def test_moving_servos_share_one_round_trip_per_tick():
+    backend, horizontal, vertical, scheduler = pan_tilt()
+    horizontal.move_to(120)
+    vertical.move_to(60)
+
+    ticks = 0
+    while backend.pulsewidths[PIN_HORIZONTAL] != 1833 or backend.pulsewidths[PIN_VERTICAL] != 1167:
+        round_trips, writes = backend.round_trips, backend.writes
+        scheduler.tick()
+        ticks += 1
+        assert backend.round_trips == round_trips + 1
+        assert backend.writes == writes + 2
+        assert ticks < 100
+
+    round_trips, writes = backend.round_trips, backend.writes
+    scheduler.tick()
+    assert (backend.round_trips, backend.writes) == (round_trips, writes)
+
+
+def test_unchanged_pulsewidth_is_not_written():
+    backend, horizontal, vertical, scheduler = pan_tilt()
+    round_trips, writes = backend.round_trips, backend.writes
+
+    horizontal.set_angle(90)
+    # Less than one microsecond of pulse, the servo moves but the pulsewidth stays
+    vertical.move_to(90.04)
+    for _ in range(5):
+        scheduler.tick()
+
+    assert (backend.round_trips, backend.writes) == (round_trips, writes)
+    assert backend.pulsewidths == {PIN_HORIZONTAL: 1500, PIN_VERTICAL: 1500}
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import cv2
+import imutils
+import numpy as np
+
+
+# Before OpenCV 3.2 findContours modified the image it was given
+CONTOURS_MODIFY_SOURCE = tuple(int(v) for v in cv2.__version__.split('.')[:2]) < (3, 2)
+
+
+class ColorSegmenter:
+    """Blur, HSV threshold, erode and dilate into buffers owned by the segmenter
+
+    Buffers are allocated for the largest frame seen and reused, smaller
+    images (ROI windows) use contiguous views at the start of them. Returned
+    masks are overwritten by the next call, copy them to keep them.
+    """
+
+    def __init__(self, min_hsv, max_hsv, blur=11, erode=2, dilate=2):
+        self._min_hsv = min_hsv
+        self._max_hsv = max_hsv
+        self._blur = (blur, blur)
+        self._erode = erode
+        self._dilate = dilate
+        self._kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        self._size = 0
+        self._blurred = self._hsv = self._mask = self._morph = None
+
+    def _buffers(self, height, width):
+        size = height * width
+        if size > self._size:
+            self._size = size
+            self._blurred = np.empty(size * 3, np.uint8)
+            self._hsv = np.empty(size * 3, np.uint8)
+            self._mask = np.empty(size, np.uint8)
+            self._morph = np.empty(size, np.uint8)
+        return (self._blurred[:size * 3].reshape(height, width, 3),
+                self._hsv[:size * 3].reshape(height, width, 3),
+                self._mask[:size].reshape(height, width),
+                self._morph[:size].reshape(height, width))
+
+    def segment(self, image):
+        """Return (mask, cleaned), the raw threshold mask and the eroded and dilated one"""
+        blurred, hsv, mask, morph = self._buffers(*image.shape[:2])
+
+        cv2.GaussianBlur(image, self._blur, 0, dst=blurred)
+        cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV, dst=hsv)
+        cv2.inRange(hsv, self._min_hsv, self._max_hsv, dst=mask)
+
+        cleaned = mask
+        if self._erode:
+            cv2.erode(cleaned, self._kernel, dst=morph, iterations=self._erode)
+            cleaned = morph
+        if self._dilate:
+            # dilate supports working in place
+            cv2.dilate(cleaned, self._kernel, dst=morph, iterations=self._dilate)
+            cleaned = morph
+        return mask, cleaned
+
+
+class BallDetector(ColorSegmenter):
+    """Find the largest blob in the HSV range"""
+
+    def detect(self, image):
+        """Return (center, (x, y), radius, mask) of the largest blob, center is None when nothing found"""
+        mask, cleaned = self.segment(image)
+
+        if CONTOURS_MODIFY_SOURCE:
+            cleaned = cleaned.copy()
+        cnts = cv2.findContours(cleaned, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cnts = imutils.grab_contours(cnts)
+
+        if len(cnts) == 0:
+            return None, None, 0, mask
+
+        c = max(cnts, key=cv2.contourArea)
+        ((x, y), radius) = cv2.minEnclosingCircle(c)
+        M = cv2.moments(c)
+        if M["m00"] == 0:
+            return None, None, 0, mask
+        center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
+
+        return center, (x, y), radius, mask
+
+
+def ball_locator(min_hsv, max_hsv):
+    """Return image -> (center, (x, y), radius), a BallDetector without the mask for worker processes"""
+    detector = BallDetector(min_hsv, max_hsv)
+
+    def locate(image):
+        center, xy, radius, _ = detector.detect(image)
+        return center, xy, radius
+
+    return locate
+
+
+class RegionOfInterest:
+    """Search window around the last known ball position
+
+    The window is sized from the last radius and the distance the ball moved
+    between the last two hits. After `misses` frames without a hit the whole
+    frame is searched again.
+    """
+
+    def __init__(self, misses=5, scale=3.0, margin=16):
+        self._misses = misses
+        self._scale = scale
+        self._margin = margin
+        self._center = None
+        self._radius = 0
+        self._velocity = (0, 0)
+        self._missed = 0
+
+    def window(self, shape):
+        """Return (x0, y0, x1, y1) to search in a frame of shape, None for the whole frame"""
+        if self._center is None:
+            return None
+
+        height, width = shape[:2]
+        # Extrapolate and widen the window for every frame the ball was missed
+        steps = self._missed + 1
+        vx, vy = self._velocity[0] * steps, self._velocity[1] * steps
+        cx = self._center[0] + vx
+        cy = self._center[1] + vy
+        half_w = int(self._radius * self._scale + abs(vx) + self._margin * steps)
+        half_h = int(self._radius * self._scale + abs(vy) + self._margin * steps)
+
+        x0, y0 = max(0, int(cx) - half_w), max(0, int(cy) - half_h)
+        x1, y1 = min(width, int(cx) + half_w), min(height, int(cy) + half_h)
+        if x1 - x0 < 2 * self._margin or y1 - y0 < 2 * self._margin:
+            return None
+        return x0, y0, x1, y1
+
+    def update(self, center, radius):
+        if center is None:
+            self._missed += 1
+            if self._missed >= self._misses:
+                self.reset()
+            return
+
+        if self._center is not None and not self._missed:
+            self._velocity = (center[0] - self._center[0], center[1] - self._center[1])
+        else:
+            self._velocity = (0, 0)
+        self._center = center
+        self._radius = radius
+        self._missed = 0
+
+    def reset(self):
+        self._center = None
+        self._velocity = (0, 0)
+        self._missed = 0
+
+
+class TrackerState:
+    """Recent (t, x, y) positions in a preallocated ring buffer and the motion estimated from them
+
+    Misses are stored as NaN positions. `dx`/`dy` are the displacement over the
+    last `window` entries from a least squares fit, positive when the object
+    moved towards the origin, same as the old two point difference.
+    """
+
+    __slots__ = ('size', 'window', 'threshold', 'thickness', 'dx', 'dy', 'direction', '_ring', '_head', '_count')
+
+    def __init__(self, size=10, window=10, threshold=20):
+        self.size = size
+        self.window = min(window, size)
+        self.threshold = threshold
+        # Trail line thickness per segment, newest first
+        self.thickness = (np.sqrt(size / np.arange(2, size + 1, dtype=float)) * 2.5).astype(int)
+        self.dx = 0
+        self.dy = 0
+        self.direction = ""
+        self._ring = np.full((size, 3), np.nan)
+        self._head = -1
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def update(self, t, center):
+        self._head = (self._head + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+        row = self._ring[self._head]
+        row[0] = t
+        if center is None:
+            row[1] = row[2] = np.nan
+            return
+        row[1], row[2] = center
+        self._estimate()
+
+    def trail(self, n=None):
+        """Return newest first (t, x, y) rows as a new array"""
+        n = self._count if n is None else min(n, self._count)
+        return self._ring[(self._head - np.arange(n)) % self.size]
+
+    def velocity(self):
+        """Return least squares (vx, vy) in px/s over the window, None with fewer than two hits"""
+        fit = self._fit()
+        return fit[:2] if fit else None
+
+    def _fit(self):
+        rows = self.trail(self.window)
+        rows = rows[~np.isnan(rows[:, 1])]
+        if len(rows) < 2:
+            return None
+        t = rows[:, 0] - rows[:, 0].mean()
+        denom = np.dot(t, t)
+        if denom == 0:
+            return None
+        vx, vy = np.dot(t, rows[:, 1:] - rows[:, 1:].mean(axis=0)) / denom
+        return vx, vy, rows[0, 0] - rows[-1, 0]
+
+    def _estimate(self):
+        fit = self._fit()
+        if not fit:
+            return
+        vx, vy, span = fit
+        self.dx = int(round(-vx * span))
+        self.dy = int(round(-vy * span))
+
+        (dirX, dirY) = ("", "")
+
+        if abs(self.dx) > self.threshold:
+            dirX = "East" if self.dx > 0 else "West"
+
+        if abs(self.dy) > self.threshold:
+            dirY = "North" if self.dy > 0 else "South"
+
+        if dirX != "" and dirY != "":
+            self.direction = "{}-{}".format(dirY, dirX)
+        else:
+            self.direction = dirX if dirX != "" else dirY
+
+
+def filter_components(stats, centroids, min_area, max_area):
+    """Return (centroids, areas) of connectedComponentsWithStats components with min_area < area < max_area
+
+    Label 0 is the background and is skipped.
+    """
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    keep = (areas > min_area) & (areas < max_area)
+    return centroids[1:][keep], areas[keep]
+
+
+class Track:
+    """One target followed by MultiTracker"""
+
+    __slots__ = ('id', 'x', 'y', 'vx', 'vy', 't', 'area', 'hits', 'misses')
+
+    def __init__(self, id, t, x, y, area):
+        self.id = id
+        self.t = t
+        self.x = x
+        self.y = y
+        self.vx = 0.0
+        self.vy = 0.0
+        self.area = area
+        self.hits = 1
+        self.misses = 0
+
+    def predict(self, t):
+        dt = t - self.t
+        return self.x + self.vx * dt, self.y + self.vy * dt
+
+    def update(self, t, x, y, area, smoothing=0.5):
+        dt = t - self.t
+        if dt > 0:
+            self.vx += smoothing * ((x - self.x) / dt - self.vx)
+            self.vy += smoothing * ((y - self.y) / dt - self.vy)
+        self.t = t
+        self.x = x
+        self.y = y
+        self.area = area
+        self.hits += 1
+        self.misses = 0
+
+    def as_dict(self):
+        # dx/dy keep the object_movement sign convention, positive towards the origin, in px/s
+        return {"id": self.id, "x": round(self.x), "y": round(self.y),
+                "dx": -round(self.vx), "dy": -round(self.vy), "area": int(self.area)}
+
+
+class MultiTracker:
+    """Assign stable ids to detections across frames
+
+    Detections are matched greedily to the predicted track positions, closest
+    pairs first, up to max_distance px. Unmatched detections start new tracks,
+    tracks unmatched for more than max_misses frames are dropped.
+    """
+
+    def __init__(self, max_distance=80, max_misses=5):
+        self._max_distance = max_distance
+        self._max_misses = max_misses
+        self._next_id = 1
+        self.tracks = []
+
+    def update(self, t, points, areas):
+        """Return the tracks matched or started by this frame's points, ordered by id"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        matched = []
+        free = np.ones(len(points), dtype=bool)
+        used = np.zeros(len(self.tracks), dtype=bool)
+
+        if self.tracks and len(points):
+            predicted = np.array([track.predict(t) for track in self.tracks])
+            distances = np.hypot(*(predicted[:, None, :] - points[None, :, :]).transpose(2, 0, 1))
+            for flat in np.argsort(distances, axis=None):
+                i, j = divmod(int(flat), len(points))
+                if distances[i, j] > self._max_distance:
+                    break
+                if used[i] or not free[j]:
+                    continue
+                used[i] = True
+                free[j] = False
+                self.tracks[i].update(t, points[j, 0], points[j, 1], areas[j])
+                matched.append(self.tracks[i])
+
+        for track, hit in zip(self.tracks, used):
+            if not hit:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self._max_misses]
+
+        for j in np.flatnonzero(free):
+            track = Track(self._next_id, t, points[j, 0], points[j, 1], areas[j])
+            self._next_id += 1
+            self.tracks.append(track)
+            matched.append(track)
+
+        matched.sort(key=lambda track: track.id)
+        return matched
+
+
+class KalmanFilter:
+    """Constant velocity ('cv') or constant acceleration ('ca') Kalman filter for an image position
+
+    Measurements are timestamped so irregular frame intervals and dropped
+    frames are handled. `q` is the process noise spectral density (how hard
+    the target may maneuver), `r` the measurement variance in px^2.
+    """
+
+    MODELS = ('cv', 'ca')
+
+    def __init__(self, model='cv', q=2000.0, r=4.0):
+        if model not in self.MODELS:
+            raise ValueError('Unknown model %s, use one of %s' % (model, ', '.join(self.MODELS)))
+        self._order = 2 if model == 'cv' else 3
+        self._q = q
+        self._r = r
+        n = 2 * self._order
+        self._H = np.zeros((2, n))
+        self._H[0, 0] = self._H[1, self._order] = 1.0
+        self._R = np.eye(2) * r
+        self._I = np.eye(n)
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.P = None
+        self.t = None
+        self.measured = None
+
+    @property
+    def initialized(self):
+        return self.x is not None
+
+    def _transition(self, dt):
+        if self._order == 2:
+            F = np.array([[1.0, dt],
+                          [0.0, 1.0]])
+            Q = np.array([[dt ** 3 / 3, dt ** 2 / 2],
+                          [dt ** 2 / 2, dt]])
+        else:
+            F = np.array([[1.0, dt, dt ** 2 / 2],
+                          [0.0, 1.0, dt],
+                          [0.0, 0.0, 1.0]])
+            Q = np.array([[dt ** 5 / 20, dt ** 4 / 8, dt ** 3 / 6],
+                          [dt ** 4 / 8, dt ** 3 / 3, dt ** 2 / 2],
+                          [dt ** 3 / 6, dt ** 2 / 2, dt]])
+        # Same independent model for both axes
+        eye = np.eye(2)
+        return np.kron(eye, F), np.kron(eye, Q * self._q)
+
+    def predict(self, t):
+        """Advance the estimate to time t"""
+        dt = t - self.t
+        if dt <= 0:
+            return
+        F, Q = self._transition(dt)
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + Q
+        self.t = t
+
+    def update(self, t, z):
+        """Fold in the position z = (x, y) measured at time t"""
+        z = np.asarray(z, dtype=float)
+        if not self.initialized:
+            self.x = np.zeros(2 * self._order)
+            self.x[0], self.x[self._order] = z
+            # Position known to the measurement noise, motion unknown
+            self.P = np.eye(2 * self._order) * 1e4
+            self.P[0, 0] = self.P[self._order, self._order] = self._r
+            self.t = self.measured = t
+            return
+
+        self.predict(t)
+        y = z - self._H @ self.x
+        S = self._H @ self.P @ self._H.T + self._R
+        K = self.P @ self._H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ y
+        self.P = (self._I - K @ self._H) @ self.P
+        self.measured = t
+
+    def coast(self, t, limit):
+        """Predict through a missing measurement, return False and reset once none came for limit seconds"""
+        if not self.initialized:
+            return False
+        if t - self.measured > limit:
+            self.reset()
+            return False
+        self.predict(t)
+        return True
+
+    def position(self):
+        return self.x[0], self.x[self._order]
+
+    def velocity(self):
+        return self.x[1], self.x[self._order + 1]
+
+    def extrapolate(self, ahead):
+        """Return the position expected ahead seconds after the current estimate"""
+        F, _ = self._transition(ahead)
+        x = F @ self.x
+        return x[0], x[self._order]
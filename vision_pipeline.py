@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+import queue
+import logging
+import multiprocessing
+import cv2
+import imutils
+import numpy as np
+from collections import deque
+from multiprocessing import shared_memory
+from threading import Condition, Thread
+
+
+class LatestQueue:
+    """Bounded queue that drops the oldest item when full, stale frames are never worth waiting for"""
+
+    def __init__(self, size=1):
+        self._items = deque(maxlen=size)
+        self._cond = Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Return the oldest item, None on timeout or when closed"""
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class RateGovernor:
+    """Pace a loop to fps, 0 means as fast as possible"""
+
+    def __init__(self, fps):
+        self._period = 1.0 / fps if fps else 0
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self._period:
+            return
+        self._next += self._period
+        delay = self._next - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Running late, start a new schedule instead of bursting to catch up
+            self._next = time.monotonic()
+
+
+class Stage(Thread):
+    """Thread taking items from a queue, passing each to func and its result to the outputs"""
+
+    def __init__(self, name, func, source, outputs=()):
+        super().__init__(name=name)
+        self.daemon = True
+        self._func = func
+        self._source = source
+        self._outputs = outputs
+        self.is_run = False
+        self.processed = 0
+
+    def run(self):
+        self.is_run = True
+        while self.is_run:
+            item = self._source.get(timeout=0.5)
+            if item is None:
+                continue
+            try:
+                result = self._func(item)
+            except Exception as e:
+                logging.exception("Stage %s failed: %s", self.name, e)
+                continue
+            self.processed += 1
+            if result is None:
+                continue
+            for output in self._outputs:
+                output.put(result)
+
+    def stop(self):
+        self.is_run = False
+
+
+class Source(Thread):
+    """Thread producing items from func at the governor rate into the outputs"""
+
+    def __init__(self, name, func, governor, outputs=()):
+        super().__init__(name=name)
+        self.daemon = True
+        self._func = func
+        self._governor = governor
+        self._outputs = outputs
+        self.is_run = False
+
+    def run(self):
+        self.is_run = True
+        while self.is_run:
+            self._governor.wait()
+            item = self._func()
+            if item is None:
+                continue
+            for output in self._outputs:
+                output.put(item)
+
+    def stop(self):
+        self.is_run = False
+
+
+class FreshFrames:
+    """Read only new frames from an imutils VideoStream
+
+    VideoStream.read() returns the same array until the camera delivers the
+    next frame, re-detecting it would feed repeated stationary samples to the
+    trackers.
+    """
+
+    def __init__(self, vs, poll=0.005):
+        self._vs = vs
+        self._poll = poll
+        self._last = None
+
+    def read(self, timeout=0.5):
+        """Return the next frame not returned before, None if none arrived within timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self._vs.read()
+            if frame is not None and frame is not self._last:
+                self._last = frame
+                return frame
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self._poll)
+
+
+def request_width(vs, width):
+    """Ask a webcam VideoStream to capture close to width before it is started, so resizing after read is cheap"""
+    capture = getattr(getattr(vs, 'stream', None), 'stream', None)
+    if capture is None or not hasattr(capture, 'set'):
+        return False
+    capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    capture.set(cv2.CAP_PROP_FRAME_HEIGHT, width * 3 // 4)
+    return True
+
+
+class FrameScaler:
+    """Resize captured frames to the output width and to the smaller processing width
+
+    Detection runs on the processing frame, `ratio` maps its coordinates back
+    to the output coordinate space that is streamed and published.
+    """
+
+    def __init__(self, width=600, process_width=0):
+        self.width = width
+        self.process_width = min(process_width or width, width)
+        self.ratio = self.width / self.process_width
+
+    def __call__(self, frame, dst=None):
+        """Return (output, processing) frames, the same array when the widths match and no dst is given"""
+        if frame.shape[1] != self.width:
+            frame = imutils.resize(frame, width=self.width)
+        if self.process_width == self.width:
+            if dst is None:
+                return frame, frame
+            np.copyto(dst, frame)
+            return frame, dst
+        return frame, self._resize(frame, self.process_width, dst)
+
+    def process(self, frame):
+        """Return only the processing frame, straight from the captured one"""
+        if frame.shape[1] == self.process_width:
+            return frame
+        return self._resize(frame, self.process_width)
+
+    @staticmethod
+    def _resize(frame, width, dst=None):
+        height = int(round(frame.shape[0] * width / frame.shape[1]))
+        return cv2.resize(frame, (width, height), dst=dst, interpolation=cv2.INTER_AREA)
+
+    def to_output(self, x, y):
+        return x * self.ratio, y * self.ratio
+
+
+class SharedFrameRing:
+    """Fixed number of equally shaped frame slots in multiprocessing shared memory
+
+    The creating process owns the memory and unlinks it on close, workers
+    attach to it by name.
+    """
+
+    def __init__(self, slots, shape, dtype=np.uint8, name=None):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._owner = name is None
+        size = slots * int(np.prod(self.shape)) * self.dtype.itemsize
+
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+
+        self.name = self._shm.name
+        self.frames = np.ndarray((slots, ) + self.shape, self.dtype, buffer=self._shm.buf)
+
+    def close(self):
+        self.frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _process_worker(name, slots, shape, dtype, factory, tasks, results):
+    ring = SharedFrameRing(slots, shape, dtype, name=name)
+    func = factory()
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            seq, slot = task
+            try:
+                result = func(ring.frames[slot])
+            except Exception as e:
+                logging.exception("Worker failed on frame %d: %s", seq, e)
+                result = None
+            results.put((seq, result))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+
+
+class Sequencer:
+    """Release results in the order they were submitted
+
+    When more than `limit` results wait for a missing one, it is given up on
+    so a lost frame cannot stall the output forever.
+    """
+
+    def __init__(self, limit=32):
+        self._limit = limit
+        self._next = 0
+        self._pending = {}
+        self.skipped = 0
+
+    def push(self, seq, item):
+        """Return the items now ready, oldest first"""
+        if seq < self._next:
+            return []
+        self._pending[seq] = item
+
+        if len(self._pending) > self._limit:
+            first = min(self._pending)
+            self.skipped += first - self._next
+            self._next = first
+
+        ready = []
+        while self._next in self._pending:
+            ready.append(self._pending.pop(self._next))
+            self._next += 1
+        return ready
+
+
+class ProcessPool:
+    """Run a function over frames in worker processes, frames travel through shared memory slots
+
+    factory is called once in each worker and returns the function applied to
+    every frame, both must be picklable (module level) and the function's
+    results small. Results come back from collect() in submission order,
+    together with the meta returned by the fill function given to submit().
+    """
+
+    def __init__(self, factory, shape, dtype=np.uint8, workers=3, slots=None):
+        slots = slots or workers * 2
+        self._ring = SharedFrameRing(slots, shape, dtype)
+        self._free = queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        # Never fork, the parent already runs MQTT, HTTP and camera threads and OpenCV
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._inflight = {}
+        self._sequencer = Sequencer(slots * 4)
+        self._seq = 0
+        self.dropped = 0
+
+        self._workers = [
+            context.Process(target=_process_worker, name='worker-%d' % i, daemon=True,
+                            args=(self._ring.name, slots, self._ring.shape, self._ring.dtype, factory, self._tasks, self._results))
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, fill):
+        """Call meta = fill(slot_array) to write a frame into a free slot and queue it, False when every slot is busy"""
+        try:
+            slot = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        meta = fill(self._ring.frames[slot])
+        seq = self._seq
+        self._seq += 1
+        self._inflight[seq] = (slot, meta)
+        self._tasks.put((seq, slot))
+        return True
+
+    def collect(self, timeout=0.5):
+        """Return the [(meta, result), ...] ready in submission order, None when nothing arrived"""
+        try:
+            seq, result = self._results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        slot, meta = self._inflight.pop(seq)
+        self._free.put(slot)
+        return self._sequencer.push(seq, (meta, result)) or None
+
+    def close(self):
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+        self._ring.close()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from itertools import count
+from threading import BoundedSemaphore, Condition, Thread
+
+OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest')
+
+
+class _Item:
+    __slots__ = ('command', 'callback', 'windowed')
+
+    def __init__(self, command, callback, windowed=True):
+        self.command = command
+        self.callback = callback
+        self.windowed = windowed
+
+
+class ATDispatcher:
+    """Bounded queue between MQTT callbacks and ATSerial, submit() never blocks
+
+    Commands submitted with the same key coalesce, only the newest pending one is sent.
+    """
+
+    def __init__(self, at, size=16, overflow='drop-oldest', window=2):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %s' % overflow)
+        self._at = at
+        self._size = size
+        self._overflow = overflow
+        self._queue = OrderedDict()
+        self._seq = count()
+        self._cond = Condition()
+        self._window = BoundedSemaphore(window)
+        self.dropped = 0
+        self.is_run = False
+
+    def submit(self, command, callback=None, key=None, preempt=False):
+        """Queue command, callback(future) is called when it completes, return False if dropped
+
+        A preempting command clears the queue and is written ahead of anything not yet sent.
+        """
+        if preempt:
+            return self._preempt(command, callback)
+
+        with self._cond:
+            item = _Item(command, callback)
+            if key is None:
+                key = next(self._seq)
+            elif key in self._queue:
+                logging.debug("Coalesce command %s", self._queue[key].command)
+                self._drop(self._queue[key])
+                self._queue[key] = item
+                return True
+
+            if len(self._queue) >= self._size:
+                if self._overflow == 'drop-newest':
+                    logging.warning("Queue full, drop command %s", command)
+                    self._drop(item)
+                    return False
+                dropped = self._queue.popitem(last=False)[1]
+                logging.warning("Queue full, drop command %s", dropped.command)
+                self._drop(dropped)
+            self._queue[key] = item
+            self._cond.notify()
+        return True
+
+    def _preempt(self, command, callback):
+        with self._cond:
+            for dropped in self._queue.values():
+                self._drop(dropped)
+            self._queue.clear()
+            item = _Item(command, callback, windowed=False)
+            future = self._at.command_async(command, urgent=True)
+
+        future.add_done_callback(lambda future: self._done(item, future))
+        return True
+
+    def run(self):
+        self.is_run = True
+        while True:
+            # Limit commands handed to ATSerial, take a slot before an item so
+            # queued commands keep coalescing and can be dropped while we wait
+            while not self._window.acquire(timeout=0.5):
+                if not self.is_run:
+                    return
+            with self._cond:
+                while self.is_run and not self._queue:
+                    self._cond.wait()
+                if not self.is_run:
+                    self._window.release()
+                    return
+                # Preemption clears the queue under this lock, what is left is current
+                item = self._queue.popitem(last=False)[1]
+                try:
+                    future = self._at.command_async(item.command)
+                except Exception as e:
+                    logging.error("Command %s failed: %s", item.command, e)
+                    self._window.release()
+                    continue
+            future.add_done_callback(lambda future, item=item: self._done(item, future))
+
+    def _drop(self, item):
+        # Dropped commands complete as cancelled so callers waiting on them are told
+        self.dropped += 1
+        if item.callback:
+            future = Future()
+            future.cancel()
+            self._done(item, future, release=False)
+
+    def _done(self, item, future, release=True):
+        if release and item.windowed:
+            self._window.release()
+        if not future.cancelled() and future.exception():
+            logging.warning("Command %s failed: %r", item.command, future.exception())
+        if item.callback:
+            try:
+                item.callback(future)
+            except Exception as e:
+                logging.error("Callback for %s failed: %s", item.command, e)
+
+    def start(self):
+        """Run in thread"""
+        # Daemon, so Ctrl-C in the MQTT loop ends the process
+        thread = Thread(target=self.run, args=[])
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        with self._cond:
+            self.is_run = False
+            self._cond.notify()
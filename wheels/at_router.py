@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+import json
+import time
+from functools import partial
+from threading import Condition, Thread
+from schema import Schema, And, Use
+
+
+class Route:
+    """Maps an MQTT topic pattern to an AT command template
+
+    Wildcard captures fill the positional template fields (uppercased), payload
+    fields fill the named ones. Payload is either a JSON object or a compact
+    comma separated list of values in `fields` order.
+
+    Pending commands coalesce per `key`, or per topic without one, unless
+    `coalesce` is off.
+    """
+
+    __slots__ = ('pattern', 'template', 'fields', 'schema', 'key', 'preempt', 'coalesce')
+
+    def __init__(self, pattern, template, fields=(), schema=None, key=None, preempt=False, coalesce=True):
+        self.pattern = pattern
+        self.template = template
+        self.fields = tuple(fields)
+        self.schema = Schema(schema, ignore_extra_keys=True) if schema else None
+        self.key = key
+        self.preempt = preempt
+        self.coalesce = coalesce
+
+    def dispatch_key(self, topic):
+        """Return the ATDispatcher coalescing key for a message on topic, None to never coalesce"""
+        if not self.coalesce:
+            return None
+        return self.key or topic
+
+    def payload(self, payload):
+        """Return (values, reply), reply is (topic, id) when a JSON payload asks for an acknowledgement"""
+        payload = payload.strip()
+        reply = None
+
+        if payload[:1] == b'{':
+            data = json.loads(payload.decode('utf-8'))
+            if 'reply' in data:
+                if not isinstance(data['reply'], str) or not data['reply']:
+                    raise ValueError('Invalid reply topic %r' % data['reply'])
+                reply = (data['reply'], data.get('id'))
+        elif not self.fields:
+            return {}, None
+        elif len(self.fields) == 1:
+            data = {self.fields[0]: payload.decode('utf-8')}
+        else:
+            values = payload.decode('utf-8').split(',')
+            if len(values) != len(self.fields):
+                raise ValueError('Expected %d values, got %d' % (len(self.fields), len(values)))
+            data = dict(zip(self.fields, values))
+
+        if not self.fields:
+            return {}, reply
+
+        if self.schema:
+            data = self.schema.validate(data)
+        return data, reply
+
+
+_uint = And(Use(int), lambda n: n >= 0)
+_move = {'interval': _uint, 'speed': _uint}
+
+WHEELS_ROUTES = (
+    Route('ronny/go/stop', '$STOP', preempt=True),
+    # All moves drive the same wheels, only the newest pending one matters
+    Route('ronny/go/forward', '$FORWARD={interval},{speed}', ('interval', 'speed'), _move, key='wheels'),
+    Route('ronny/go/backward', '$BACKWARD={interval},{speed}', ('interval', 'speed'), _move, key='wheels'),
+    Route('ronny/go/left', '$LEFT={interval},{speed}', ('interval', 'speed'), _move, key='wheels'),
+    Route('ronny/go/right', '$RIGHT={interval},{speed}', ('interval', 'speed'), _move, key='wheels'),
+)
+
+BODY_ROUTES = (
+    Route('at/+', '${0}={value}', ('value', ), {'value': Use(str)}),
+    # Queries answer on the reply topic given in a JSON payload, every caller gets its own answer
+    Route('at/+/get', '${0}?', coalesce=False),
+)
+
+
+class Router:
+    """Precompiled topic to command lookup shared by the AT bridges"""
+
+    def __init__(self, routes, cache_size=256):
+        self._routes = tuple(routes)
+        self._exact = {}
+        self._wildcard = []
+        self._cache = {}
+        self._cache_size = cache_size
+
+        for route in self._routes:
+            if '+' in route.pattern or '#' in route.pattern:
+                regex = '^' + re.escape(route.pattern).replace(r'\+', '([^/]+)').replace(r'\#', '(.+)') + '$'
+                self._wildcard.append((re.compile(regex), route))
+            else:
+                self._exact[route.pattern] = (route, route.template.format)
+
+    def topics(self):
+        return [route.pattern for route in self._routes]
+
+    def match(self, topic):
+        """Return (route, formatter) for topic or None"""
+        hit = self._exact.get(topic)
+        if hit:
+            return hit
+
+        hit = self._cache.get(topic)
+        if hit:
+            return hit
+
+        for regex, route in self._wildcard:
+            m = regex.match(topic)
+            if m:
+                captures = [group.upper() for group in m.groups()]
+                hit = (route, partial(route.template.format, *captures))
+                if len(self._cache) >= self._cache_size:
+                    self._cache.clear()
+                self._cache[topic] = hit
+                return hit
+
+        return None
+
+    def resolve(self, topic, payload):
+        """Return (route, command, reply) for message or None, raise ValueError/SchemaError on bad payload"""
+        hit = self.match(topic)
+        if not hit:
+            return None
+        route, formatter = hit
+        values, reply = route.payload(payload)
+        return route, formatter(**values), reply
+
+
+def ack_callback(mqttc, reply, command):
+    """Return dispatcher callback publishing the command outcome to the reply topic"""
+    topic, correlation_id = reply
+
+    def callback(future):
+        response = None
+        rtt = getattr(future, 'rtt', None)
+        if future.cancelled():
+            error = 'cancelled'
+        elif future.exception():
+            error = type(future.exception()).__name__
+        else:
+            response = future.result()
+            error = None if response is not None else 'ERROR'
+
+        mqttc.publish(topic, json.dumps({
+            "id": correlation_id,
+            "command": command,
+            "response": response,
+            "error": error,
+            "rtt_ms": round(rtt * 1000, 3) if rtt is not None else None,
+        }), qos=0)
+
+    return callback
+
+
+class TelemetryPublisher:
+    """Republish decoded telemetry to MQTT, one topic per top level key
+
+    Unchanged values are not republished and each topic is published at most
+    once per interval. A change arriving within the interval is held back and
+    published when the interval ends, so the last value always reaches MQTT.
+    """
+
+    def __init__(self, mqttc, prefix, interval=0.2):
+        self._mqttc = mqttc
+        self._prefix = prefix.rstrip('/')
+        self._interval = interval
+        self._last = {}
+        self._held = {}
+        self._due = {}
+        self._cond = Condition()
+        self._thread = None
+
+    def subscribe(self, at):
+        at.telemetry.subscribe('{', self.on_json)
+        at.telemetry.subscribe('#', self.on_debug)
+
+    def on_json(self, line, data):
+        if isinstance(data, dict):
+            for key, value in data.items():
+                self.publish(self._prefix + '/' + str(key), json.dumps(value, sort_keys=True))
+        else:
+            self.publish(self._prefix, json.dumps(data, sort_keys=True))
+
+    def on_debug(self, line, text):
+        self.publish(self._prefix + '/debug', text, dedup=False)
+
+    def publish(self, topic, payload, dedup=True):
+        with self._cond:
+            now = time.monotonic()
+            last = self._last.get(topic)
+            if last is not None:
+                if dedup and last[1] == payload:
+                    # Back to the published value, nothing held back is newer
+                    self._held.pop(topic, None)
+                    return
+                if now - last[0] < self._interval:
+                    self._held[topic] = payload
+                    if topic not in self._due:
+                        self._due[topic] = last[0] + self._interval
+                        self._cond.notify()
+                    if self._thread is None:
+                        # One thread releases held values for every topic
+                        self._thread = Thread(target=self.run, args=[])
+                        self._thread.daemon = True
+                        self._thread.start()
+                    return
+            self._last[topic] = (now, payload)
+            self._held.pop(topic, None)
+        self._mqttc.publish(topic, payload, qos=0)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._due:
+                    self._cond.wait()
+                topic = min(self._due, key=self._due.get)
+                now = time.monotonic()
+                if self._due[topic] > now:
+                    self._cond.wait(self._due[topic] - now)
+                    continue
+                del self._due[topic]
+                payload = self._held.pop(topic, None)
+                if payload is None:
+                    continue
+                self._last[topic] = (now, payload)
+            self._mqttc.publish(topic, payload, qos=0)
@@ -9,103 +9,687 @@ import logging
 import serial
 import decimal
 import platform
+import asyncio
+import contextlib
+import json
+import struct
 from ctypes import *
-from threading import Condition, Lock, Thread, Event
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from functools import partial
+from threading import Condition, Lock, Thread
 try:
     import fcntl
 except ImportError:
     fcntl = None
 
+_WHITESPACE = b' \t\r\n\x1b'
+
+
+class LineFramer:
+    """Split a byte stream into lines, frames are passed as memoryview slices"""
+
+    def __init__(self, max_line=4096):
+        self._buf = bytearray()
+        self._max_line = max_line
+
+    def feed(self, data, on_frame):
+        buf = self._buf
+        buf += data
+        start = 0
+        with memoryview(buf) as view:
+            while True:
+                end = buf.find(b'\n', start)
+                if end < 0:
+                    break
+                head = start
+                tail = end
+                while head < tail and buf[head] in _WHITESPACE:
+                    head += 1
+                while tail > head and buf[tail - 1] in _WHITESPACE:
+                    tail -= 1
+                if head < tail:
+                    on_frame(view[head:tail])
+                start = end + 1
+        if start:
+            del buf[:start]
+        if len(buf) > self._max_line:
+            logging.warning("Drop %d bytes without line end", len(buf))
+            del buf[:]
+
+    def reset(self):
+        del self._buf[:]
+
+
+class TelemetryDecoder:
+    """Decode unsolicited {json} and #debug lines in a thread, dispatch them by line prefix"""
+
+    def __init__(self, size=64):
+        self._index = {}
+        self._queue = deque(maxlen=size)
+        self._cond = Condition()
+        self._thread = None
+        self.is_run = False
+
+    def subscribe(self, prefix, callback):
+        """Call callback(line, data) for lines starting with prefix, data is parsed JSON or debug text"""
+        prefix = prefix.encode() if isinstance(prefix, str) else prefix
+        with self._cond:
+            self._index.setdefault(prefix[0], []).append((prefix, callback))
+            if self._thread is None:
+                self._thread = Thread(target=self.run, args=[])
+                self._thread.daemon = True
+                self._thread.start()
+
+    def feed(self, frame):
+        # Called from the reader, only copies lines someone subscribed to
+        if frame[0] not in self._index:
+            return
+        with self._cond:
+            self._queue.append(frame.tobytes())
+            self._cond.notify()
+
+    def run(self):
+        self.is_run = True
+        while True:
+            with self._cond:
+                while self.is_run and not self._queue:
+                    self._cond.wait()
+                if not self.is_run:
+                    return
+                line = self._queue.popleft()
+            self._dispatch(line)
+
+    def _dispatch(self, line):
+        data = None
+        for prefix, callback in self._index.get(line[0], ()):
+            if not line.startswith(prefix):
+                continue
+            if data is None:
+                try:
+                    if line[0] == 0x7b:
+                        data = json.loads(line.decode('utf-8'))
+                    else:
+                        data = line[1:].decode('utf-8', 'replace').strip()
+                except ValueError as e:
+                    logging.warning("Invalid telemetry %s: %s", line, e)
+                    return
+            try:
+                callback(line, data)
+            except Exception as e:
+                logging.error("Telemetry callback failed: %s", e)
+
+    def stop(self):
+        with self._cond:
+            self.is_run = False
+            self._cond.notify()
+
+
+class ResponseCache:
+    """TTL cache for idempotent query commands, i.e. the ones ending with ?
+
+    A cached query is dropped when a write to the same command name (or to one
+    of its declared invalidators) goes through.
+    """
+
+    def __init__(self, size=64):
+        self._size = size
+        self._rules = []
+        self._rule_of = {}
+        self._entries = OrderedDict()
+        self._by_name = {}
+        self._watch = {}
+        self._generation = {}
+        self._lock = Lock()
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    def declare(self, prefix, ttl, invalidated_by=()):
+        """Cache queries starting with prefix for ttl seconds"""
+        with self._lock:
+            self._rules.append((prefix, ttl, tuple(invalidated_by)))
+            self._rule_of.clear()
+
+    @staticmethod
+    def _name(command):
+        return command.partition('=')[0].partition('?')[0]
+
+    def _rule(self, command):
+        rule = self._rule_of.get(command, False)
+        if rule is False:
+            rule = next((r for r in self._rules if command.startswith(r[0])), None)
+            if len(self._rule_of) < 1024:
+                self._rule_of[command] = rule
+        return rule
+
+    def lookup(self, command):
+        """Return (response, None) on hit, (None, token) on miss, (None, None) if not cacheable"""
+        with self._lock:
+            rule = self._rule(command)
+            if rule is None:
+                return None, None
+
+            entry = self._entries.get(command)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(command)
+                    return list(entry[1]), None
+                self._remove(command)
+
+            name = self._name(command)
+            for writer in (name, ) + rule[2]:
+                self._watch.setdefault(writer, set()).add(name)
+            return None, (name, self._generation.get(name, 0), rule[1])
+
+    def store(self, command, token, future):
+        if future.cancelled() or future.exception() or future.result() is None:
+            return
+        name, generation, ttl = token
+        with self._lock:
+            # A write went through while the query was in flight
+            if self._generation.get(name, 0) != generation:
+                return
+            self._entries[command] = (time.monotonic() + ttl, tuple(future.result()))
+            self._entries.move_to_end(command)
+            self._by_name.setdefault(name, set()).add(command)
+            while len(self._entries) > self._size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, command):
+        name = self._name(command)
+        if name not in self._watch:
+            return
+        with self._lock:
+            for query in self._watch.get(name, ()):
+                self._generation[query] = self._generation.get(query, 0) + 1
+                for cached in self._by_name.pop(query, ()):
+                    self._entries.pop(cached, None)
+
+    def _remove(self, command):
+        self._entries.pop(command, None)
+        commands = self._by_name.get(self._name(command))
+        if commands:
+            commands.discard(command)
+
+
+def _crc8_table(poly=0x07):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+        table.append(crc)
+    return bytes(table)
+
+
+_CRC8 = _crc8_table()
+
+
+def crc8(data, crc=0):
+    for byte in data:
+        crc = _CRC8[crc ^ byte]
+    return crc
+
+
+class BinaryCodec:
+    """Compact frames for high-rate commands: 0xA5, length, opcode, payload, CRC-8
+
+    Length counts opcode and payload, the CRC covers length, opcode and payload.
+    Commands without an opcode, or with values out of range, stay text AT.
+    """
+
+    START = 0xA5
+
+    # name: (opcode, regex for the arguments, struct format)
+    OPCODES = {
+        '$S': (0x10, re.compile(r'^(\d+)=(\d+)$'), '<BH'),
+        '$FORWARD': (0x20, re.compile(r'^=(\d+),(\d+)$'), '<HH'),
+        '$BACKWARD': (0x21, re.compile(r'^=(\d+),(\d+)$'), '<HH'),
+        '$LEFT': (0x22, re.compile(r'^=(\d+),(\d+)$'), '<HH'),
+        '$RIGHT': (0x23, re.compile(r'^=(\d+),(\d+)$'), '<HH'),
+        '$STOP': (0x24, re.compile(r'^$'), '<'),
+    }
+
+    _PREFIX = re.compile(r'^(\$STOP|\$FORWARD|\$BACKWARD|\$LEFT|\$RIGHT|\$S)(.*)$')
+
+    def encode(self, command):
+        m = self._PREFIX.match(command)
+        if not m:
+            return None
+        opcode, args, fmt = self.OPCODES[m.group(1)]
+        a = args.match(m.group(2))
+        if not a:
+            return None
+        try:
+            body = bytes((opcode, )) + struct.pack(fmt, *(int(value) for value in a.groups()))
+        except struct.error:
+            return None
+        head = bytes((len(body), )) + body
+        return bytes((self.START, )) + head + bytes((crc8(head), ))
+
+    def decode(self, buf):
+        """Return (command, consumed) for a frame at the start of buf, (None, 0) if incomplete"""
+        if len(buf) < 2 or len(buf) < buf[1] + 3:
+            return None, 0
+        length = buf[1]
+        head = bytes(buf[1:length + 2])
+        consumed = length + 3
+        if length < 1 or crc8(head) != buf[length + 2]:
+            raise ValueError('Bad frame %s' % bytes(buf[:consumed]).hex())
+        opcode = head[1]
+        for name, (code, _, fmt) in self.OPCODES.items():
+            if code != opcode:
+                continue
+            try:
+                values = struct.unpack(fmt, head[2:])
+            except struct.error:
+                raise ValueError('Bad %s frame %s' % (name, bytes(buf[:consumed]).hex()))
+            if name == '$S':
+                return '$S%d=%d' % values, consumed
+            if values:
+                return '%s=%s' % (name, ','.join(str(value) for value in values)), consumed
+            return name, consumed
+        raise ValueError('Unknown opcode 0x%02x' % opcode)
+
+
+class ATTimeout(Exception):
+    pass
+
+
+class ATDisconnected(Exception):
+    pass
+
+
+class _Request:
+    __slots__ = ('command', 'future', 'timeout', 'sent', 'deadline', 'response')
+
+    def __init__(self, command, future, timeout):
+        self.command = command
+        self.future = future
+        self.timeout = timeout
+        self.sent = None
+        self.deadline = None
+        self.response = []
+
+
 class ATSerial:
 
-    def __init__(self, device):
+    def __init__(self, device, pipeline=4, timeout=3, resync=(), backoff=(0.01, 1.0), baudrate=115200):
         self._ser = None
         self._device = device
         self.on_line = None
 
+        self._pipeline = pipeline
+        self._timeout = timeout
+        self._resync = tuple(resync)
+        self._backoff = backoff
+        self._baudrate = baudrate
+        self._initial_baudrate = baudrate
+        self._want_baudrate = None
+        self._deferred = deque()
+        self._codec = BinaryCodec()
+        self._binary = False
+        self._want_binary = False
         self._command = Lock()
-        self._event = Event()
-        self._response = None
+        self._queued = deque()
+        self._pending = deque()
+        self._framer = LineFramer()
+        self.telemetry = TelemetryDecoder()
+        self.cache = ResponseCache()
+        self._connected = False
+        self._draining = False
+        self._replaying = False
+        self._epoch = 0
+
+        self._open(settle=0.5)
+
+        self.is_run = False
+
+    def __del__(self):
+        self._close()
 
+    def _open(self, settle=0):
         logging.info("Connecting on device %s", self._device)
-        self._ser = serial.Serial(self._device, baudrate=115200, timeout=3)
+        ser = serial.Serial(self._device, baudrate=self._baudrate, timeout=0.1)
+        self._ser = ser
 
-        self._lock()
-        self._speed_up()
+        try:
+            self._lock()
+            self._speed_up()
+        except Exception:
+            self._ser = None
+            ser.close()
+            raise
 
         logging.info("Success connect on device %s", self._device)
 
         self._ser.flush()
         self._ser.reset_input_buffer()
         self._ser.reset_output_buffer()
-        time.sleep(0.5)
+        if settle:
+            time.sleep(settle)
         self._ser.write(b'\x1b')
+        self._framer.reset()
+        self._connected = True
 
-        self.is_run = False
-
-    def __del__(self):
-        self._unlock()
-        try:
-            self._ser.close()
-        except Exception as e:
-            pass
-        self._ser = None
+    def _close(self):
+        # Under the command lock so no _send writes to a port being closed
+        with self._command:
+            self._connected = False
+            try:
+                self._unlock()
+            except Exception as e:
+                pass
+            try:
+                self._ser.close()
+            except Exception as e:
+                pass
+            self._ser = None
 
     def run(self):
         self.is_run = True
         while self.is_run:
-            self._loop()
+            try:
+                self._loop()
+            except (serial.SerialException, OSError) as e:
+                # A hung-up USB tty raises plain OSError(EIO) from in_waiting
+                self._reconnect()
 
     def _loop(self):
         try:
-            line = self._ser.readline()
-        except serial.SerialException as e:
+            data = self._ser.read(self._ser.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
             logging.error("SerialException %s", e)
-            self._ser.close()
             raise
 
-        if line:
-            logging.debug("Read line %s", line)
+        if data:
+            self._framer.feed(data, self._on_frame)
 
-            line = line.decode().strip()
+        self._expire()
 
-            if line[0] == '{':
-                return
+        while self._deferred:
+            self._deferred.popleft()()
+
+    def _disconnect(self):
+        # A reset device is back at its boot speed and text framing, _replay restores both
+        self._replaying = True
+        self._epoch += 1
+        self._binary = False
+        self._baudrate = self._initial_baudrate
+        self._close()
+        self._fail(ATDisconnected(self._device))
+
+    def _reconnect(self):
+        self._disconnect()
+
+        delay = self._backoff[0]
+        while self.is_run:
+            try:
+                self._open()
+                break
+            except Exception as e:
+                logging.warning("Reconnect to %s failed: %s", self._device, e)
+                time.sleep(delay)
+                delay = min(delay * 2, self._backoff[1])
+        else:
+            return
+
+        self._replay()
+
+    def _replay(self):
+        # command_async() fails with ATDisconnected until this is done, so no
+        # command crosses the device's speed switch or goes ahead of the resync
+        if self._want_baudrate and self._want_baudrate != self._baudrate:
+            self._then(self.set_baudrate(self._want_baudrate), self._replay_binary)
+        else:
+            self._replay_binary()
+
+    def _replay_binary(self):
+        if self._want_binary:
+            self._then(self.enable_binary(), self._replay_resync)
+        else:
+            self._replay_resync()
+
+    def _replay_resync(self):
+        for command in self._resync:
+            logging.info("Resync %s", command)
+            self._submit(command, gated=False)
+        self._replaying = False
+
+    def _then(self, future, func):
+        # Next replay step, dropped if the link was lost again in the meantime
+        epoch = self._epoch
+        future.add_done_callback(lambda future: self._defer(lambda: epoch == self._epoch and func()))
+
+    def _defer(self, func):
+        # Run func from the reader loop, outside the command lock held by completion callbacks
+        self._deferred.append(func)
+
+    def _fail(self, exc):
+        # Nothing queued survives a disconnect, stale moves must not replay
+        with self._command:
+            requests = list(self._pending) + list(self._queued)
+            self._pending.clear()
+            self._queued.clear()
+            self._draining = False
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(exc)
 
-            if line[0] == '#':
+    def _on_frame(self, frame):
+        # Telemetry and debug output are decoded off the reader thread
+        if frame[0] == 0x7b or frame[0] == 0x23:
+            self.telemetry.feed(frame)
+            return
+
+        if self.on_line:
+            line = str(frame, 'utf-8', 'replace')
+            logging.debug("Read line %s", line)
+            self.on_line(line)
+            return
+
+        with self._command:
+            # A failed _send removes its request from another thread
+            if not self._pending:
                 return
+            request = self._pending[0]
+            if frame == b'OK':
+                self._finish(request.response)
+            elif frame == b'ERROR':
+                self._finish(None)
+            else:
+                line = str(frame, 'utf-8', 'replace')
+                logging.debug("Read line %s", line)
+                if frame[0] == 0x2b:
+                    request = self._claim(line)
+                    if request is None:
+                        return
+                request.response.append(line)
 
-            if self.on_line:
-                self.on_line(line)
+    def _claim(self, line):
+        # Called with self._command held. A +NAME: line answers the oldest pending
+        # $NAME? query, whatever is queued ahead of it lost its response and would
+        # otherwise take the next one's, shifting every reply after it
+        name = line[1:].partition(':')[0].strip()
+        for index, request in enumerate(self._pending):
+            if request.command[-1:] == '?' and request.command[:-1].lstrip('$') == name:
+                break
+        else:
+            head = self._pending[0]
+            if head.command[-1:] == '?':
+                logging.warning("Drop %s, no %s? waiting for it", line, name)
+                return None
+            return head
+        for _ in range(index):
+            lost = self._pending.popleft()
+            if not lost.future.done():
+                logging.warning("Command %s response lost", lost.command)
+                lost.future.set_exception(ATTimeout(lost.command))
+        return request
 
-            elif self._response is not None:
-                if line == 'OK':
-                    self._event.set()
-                elif line == 'ERROR':
-                    self._response = None
-                    self._event.set()
-                else:
-                    self._response.append(line)
+    def command_async(self, command, timeout=None, urgent=False):
+        """Queue command, return Future resolved with response lines (None on ERROR)
 
-    def command(self, command):
+        The future gets an `rtt` attribute with the serial round trip in seconds.
+        An urgent command cancels everything not yet written and goes out immediately.
+        Queries declared in self.cache are answered from it while fresh.
+        """
+        return self._submit(command, timeout, urgent)
+
+    def _submit(self, command, timeout=None, urgent=False, gated=True):
+        # Only the link setup replayed after a reconnect passes gated=False
+        future = self._create_future()
+        if not self._connected:
+            future.set_exception(ATDisconnected(self._device))
+            return future
+        if self.cache:
+            if command[-1:] == '?':
+                response, token = self.cache.lookup(command)
+                if response is not None:
+                    future.rtt = 0
+                    future.set_result(response)
+                    return future
+                if token is not None:
+                    future.add_done_callback(partial(self.cache.store, command, token))
+            else:
+                self.cache.invalidate(command)
+        request = _Request(command, future, self._timeout if timeout is None else timeout)
         with self._command:
-            logging.debug("Command %s", command)
-            self._event.clear()
-            command = 'AT' + command + '\r\n'
-            self._response = []
-            self._ser.write(command.encode('ascii'))
-            if self.is_run:
-                self._event.wait()
+            if gated and self._replaying:
+                future.set_exception(ATDisconnected(self._device))
+                return future
+            if urgent:
+                queued = list(self._queued)
+                self._queued.clear()
+                self._send(request)
             else:
-                while not self._event.is_set():
-                    self._loop()
-            response = self._response
-            self._response = None
-            return response
+                queued = None
+                self._queued.append(request)
+                self._flush()
+        if queued:
+            for request in queued:
+                request.future.cancel()
+        return future
+
+    def command(self, command, timeout=None):
+        future = self.command_async(command, timeout)
+        if not self.is_run:
+            while not future.done():
+                self._loop()
+        return future.result()
+
+    def _flush(self):
+        # Called with self._command held, keeps up to `pipeline` commands on the wire
+        if self._draining:
+            # After a timeout nothing new is sent until every reply still owed
+            # has come in or been given up on, so none lands on a new command
+            if self._pending:
+                return
+            self._draining = False
+        while self._queued and len(self._pending) < self._pipeline and self._connected:
+            request = self._queued.popleft()
+            if not request.future.done():
+                self._send(request)
+
+    def _send(self, request):
+        # Called with self._command held
+        logging.debug("Command %s", request.command)
+        request.sent = time.monotonic()
+        request.deadline = request.sent + request.timeout
+        self._pending.append(request)
+        frame = self._codec.encode(request.command) if self._binary else None
+        try:
+            self._ser.write(frame or ('AT' + request.command + '\r\n').encode('ascii'))
+        except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+            # The reader notices the lost port and reconnects
+            self._pending.remove(request)
+            request.future.set_exception(ATDisconnected(self._device))
+            return
+        self._arm(request)
+
+    def _create_future(self):
+        return Future()
+
+    def _arm(self, request):
+        # The reader thread polls deadlines in _loop
+        pass
+
+    def _finish(self, response):
+        # Called with self._command held, responses are matched in FIFO order
+        request = self._pending.popleft()
+        if not request.future.done():
+            request.future.rtt = time.monotonic() - request.sent
+            request.future.set_result(response)
+        self._flush()
+
+    def _expire(self):
+        if not self._pending:
+            return
+        now = time.monotonic()
+        with self._command:
+            for request in self._pending:
+                if request.deadline <= now and not request.future.done():
+                    logging.warning("Command %s timeout", request.command)
+                    request.future.set_exception(ATTimeout(request.command))
+                    self._draining = True
+            # An expired request stays queued to absorb a late response, unless
+            # it is stuck at the head for another full timeout
+            while self._pending and self._pending[0].deadline + self._pending[0].timeout <= now:
+                self._pending.popleft()
+                self._flush()
+
+    def set_baudrate(self, baudrate):
+        """Ask the device to switch link speed, keep the current one if it answers ERROR
+
+        Return future resolved with True once switched. Call before other traffic,
+        commands pipelined behind it would be sent at the new rate.
+        """
+        self._want_baudrate = baudrate
+        result = self._create_future()
+        future = self._submit('$BAUD=%d' % baudrate, gated=False)
+        future.add_done_callback(partial(self._baudrate_done, baudrate, result))
+        return result
+
+    def _baudrate_done(self, baudrate, result, future):
+        if future.cancelled() or future.exception() or future.result() is None:
+            logging.warning("Device %s stays at %d baud", self._device, self._baudrate)
+            result.set_result(False)
+            return
+        self._ser.flush()
+        self._ser.baudrate = baudrate
+        self._baudrate = baudrate
+        logging.info("Device %s switched to %d baud", self._device, baudrate)
+        result.set_result(True)
+
+    def enable_binary(self):
+        """Send high-rate commands as binary frames if the device supports it, text AT otherwise
+
+        Return future resolved with True when binary framing is in use.
+        """
+        self._want_binary = True
+        result = self._create_future()
+        future = self._submit('$BIN=1', gated=False)
+        future.add_done_callback(partial(self._binary_done, result))
+        return result
+
+    def _binary_done(self, result, future):
+        self._binary = not future.cancelled() and not future.exception() and future.result() is not None
+        if self._binary:
+            logging.info("Device %s uses binary framing", self._device)
+        else:
+            logging.warning("Device %s has no binary framing, using text AT", self._device)
+        result.set_result(self._binary)
 
     def start(self):
-        """Run in thread"""
-        Thread(target=self.run, args=[]).start()
+        """Run in thread, return the thread"""
+        # Set before the thread runs, or command() right after start() reads the port too
+        self.is_run = True
+        # Daemon, so Ctrl-C in the MQTT loop ends the process
+        thread = Thread(target=self.run, args=[])
+        thread.daemon = True
+        thread.start()
+        return thread
 
     def _lock(self):
         if not fcntl or not self._ser:
@@ -158,3 +742,70 @@ class ATSerial:
             fcntl.ioctl(self._ser.fileno(), TIOCSSERIAL, buf)
         except Exception as e:
             pass
+
+
+class AsyncATSerial(ATSerial):
+    """ATSerial driven by an asyncio event loop instead of a reader thread
+
+    Create it inside a coroutine to use the running loop, or pass loop.
+    """
+
+    def __init__(self, device, loop=None, **kwargs):
+        self._aio = loop or asyncio.get_running_loop()
+        super().__init__(device, **kwargs)
+        self._command = contextlib.nullcontext()
+        self._fd = None
+        self._attach()
+        self.is_run = True
+
+    def _attach(self):
+        self._ser.timeout = 0
+        self._fd = self._ser.fileno()
+        self._aio.add_reader(self._fd, self._on_readable)
+
+    def _detach(self):
+        if self._fd is not None:
+            self._aio.remove_reader(self._fd)
+            self._fd = None
+
+    def _on_readable(self):
+        try:
+            self._loop()
+        except (serial.SerialException, OSError) as e:
+            self._detach()
+            self._disconnect()
+            self._aio.call_soon(self._reconnect_step, self._backoff[0])
+
+    def _reconnect_step(self, delay):
+        if not self.is_run:
+            return
+        try:
+            self._open()
+        except Exception as e:
+            logging.warning("Reconnect to %s failed: %s", self._device, e)
+            self._aio.call_later(delay, self._reconnect_step, min(delay * 2, self._backoff[1]))
+            return
+        self._attach()
+        self._replay()
+
+    def _create_future(self):
+        return self._aio.create_future()
+
+    def _defer(self, func):
+        self._aio.call_soon(func)
+
+    def _arm(self, request):
+        self._aio.call_later(request.timeout, self._expire)
+        self._aio.call_later(request.timeout * 2, self._expire)
+
+    async def command(self, command, timeout=None):
+        return await self.command_async(command, timeout)
+
+    def start(self):
+        raise RuntimeError("AsyncATSerial is driven by the event loop")
+
+    def close(self):
+        self.is_run = False
+        self._detach()
+        self._close()
+        self._fail(ATDisconnected(self._device))